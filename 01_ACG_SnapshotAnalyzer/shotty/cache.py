@@ -0,0 +1,256 @@
+"""Local sqlite cache of the EC2 inventory."""
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import json
+import os
+import sqlite3
+import time
+
+from shotty.inventory import MAX_FILTER_VALUES, Inventory, tags_of
+
+TIME_KEYS = {'AttachTime', 'CreateTime', 'LaunchTime', 'StartTime'}
+
+
+def cache_path():
+    """Get the file shotty keeps its inventory cache in."""
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'shotty' / 'inventory.sqlite'
+
+
+def dumps(item):
+    return json.dumps(item, default=lambda value: value.isoformat())
+
+
+def loads(data):
+    def parse_times(item):
+        for key in TIME_KEYS & item.keys():
+            item[key] = datetime.fromisoformat(item[key])
+        return item
+    return json.loads(data, object_hook=parse_times)
+
+
+class InventoryCache:
+    """Instances, volumes and snapshots of every region, kept on disk.
+
+    Instances and volumes take one call each and are fetched in full on
+    every refresh. Snapshots are refreshed incrementally: only those
+    started since the newest one cached, found with start-time
+    wildcards, and those still pending. Deleted snapshots are only
+    noticed by a full refresh, which happens once per FULL_REFRESH
+    seconds or when a refresh is forced with a max_age of 0; commands
+    deleting snapshots evict them themselves. Project filters are
+    answered by indexed queries.
+    """
+
+    FULL_REFRESH = 24 * 3600
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path=None):
+        """Create an InventoryCache stored in the sqlite file at path."""
+        self.path = Path(path or cache_path())
+
+    def connect(self):
+        """Open the sqlite file, creating the tables if needed."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            for table in ('instances', 'volumes', 'snapshots', 'refreshes'):
+                conn.execute("DROP TABLE IF EXISTS {}".format(table))
+            conn.execute("PRAGMA user_version = {}".format(
+                self.SCHEMA_VERSION))
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS instances (
+                region TEXT,
+                id TEXT,
+                project TEXT,
+                data TEXT,
+                PRIMARY KEY (region, id)
+            );
+            CREATE INDEX IF NOT EXISTS instances_project
+                ON instances (region, project);
+            CREATE TABLE IF NOT EXISTS volumes (
+                region TEXT,
+                id TEXT,
+                instance_id TEXT,
+                data TEXT,
+                PRIMARY KEY (region, id)
+            );
+            CREATE INDEX IF NOT EXISTS volumes_instance
+                ON volumes (region, instance_id);
+            CREATE TABLE IF NOT EXISTS snapshots (
+                region TEXT,
+                id TEXT,
+                volume_id TEXT,
+                state TEXT,
+                start_time TEXT,
+                data TEXT,
+                PRIMARY KEY (region, id)
+            );
+            CREATE INDEX IF NOT EXISTS snapshots_volume
+                ON snapshots (region, volume_id);
+            CREATE TABLE IF NOT EXISTS refreshes (
+                region TEXT PRIMARY KEY,
+                refreshed REAL,
+                full_refreshed REAL,
+                watermark TEXT
+            );
+            """)
+        return conn
+
+    def refreshes(self, conn, region):
+        """Get (refreshed, full_refreshed, watermark) of region."""
+        row = conn.execute(
+            "SELECT refreshed, full_refreshed, watermark FROM refreshes "
+            "WHERE region = ?", (region,)).fetchone()
+        return row or (None, None, None)
+
+    @staticmethod
+    def snapshot_filters(watermark, pending):
+        """Get filter sets finding snapshots changed since watermark.
+
+        EC2 has no range filter on start-time, but it matches
+        wildcards, so every day since the watermark is one value.
+        """
+        day = datetime.fromisoformat(watermark).date()
+        today = datetime.now(timezone.utc).date()
+        days = []
+        while day <= today:
+            days.append(day.isoformat() + '*')
+            day += timedelta(days=1)
+
+        filter_sets = [[{'Name': 'start-time', 'Values': days}]]
+        for start in range(0, len(pending), MAX_FILTER_VALUES):
+            filter_sets.append([{
+                'Name': 'snapshot-id',
+                'Values': pending[start:start + MAX_FILTER_VALUES]}])
+        return filter_sets
+
+    def refresh(self, client, full=False):
+        """Fetch the inventory of the client's region into the cache."""
+        region = client.meta.region_name
+        fetch = Inventory(client)
+        now = time.time()
+
+        conn = self.connect()
+        try:
+            _, full_refreshed, watermark = self.refreshes(conn, region)
+            full = full or watermark is None or \
+                now - full_refreshed > self.FULL_REFRESH
+
+            filter_sets = [[]]
+            if not full:
+                pending = [row[0] for row in conn.execute(
+                    "SELECT id FROM snapshots WHERE region = ? AND "
+                    "state = 'pending'", (region,))]
+                filter_sets = self.snapshot_filters(watermark, pending)
+
+            instances = list(fetch.describe('describe_instances',
+                                            'Reservations'))
+            volumes = list(fetch.describe('describe_volumes', 'Volumes'))
+            snapshots = {s['SnapshotId']: s
+                         for filters in filter_sets
+                         for s in fetch.describe('describe_snapshots',
+                                                 'Snapshots', filters,
+                                                 OwnerIds=['self'])}
+
+            with conn:
+                conn.execute("DELETE FROM instances WHERE region = ?",
+                             (region,))
+                conn.executemany(
+                    "INSERT INTO instances VALUES (?, ?, ?, ?)",
+                    ((region, i['InstanceId'], tags_of(i).get('Project'),
+                      dumps(i)) for i in instances))
+
+                conn.execute("DELETE FROM volumes WHERE region = ?",
+                             (region,))
+                conn.executemany(
+                    "INSERT INTO volumes VALUES (?, ?, ?, ?)",
+                    ((region, v['VolumeId'],
+                      (v.get('Attachments') or [{}])[0].get('InstanceId'),
+                      dumps(v)) for v in volumes))
+
+                if full:
+                    conn.execute("DELETE FROM snapshots WHERE region = ?",
+                                 (region,))
+                    full_refreshed = now
+                conn.executemany(
+                    "INSERT OR REPLACE INTO snapshots "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    ((region, s['SnapshotId'], s['VolumeId'], s['State'],
+                      s['StartTime'].isoformat(), dumps(s))
+                     for s in snapshots.values()))
+
+                newest = conn.execute(
+                    "SELECT MAX(start_time) FROM snapshots "
+                    "WHERE region = ?", (region,)).fetchone()[0]
+                conn.execute(
+                    "INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?)",
+                    (region, now, full_refreshed,
+                     newest or datetime.fromtimestamp(
+                         now, timezone.utc).isoformat()))
+        finally:
+            conn.close()
+
+    def evict_snapshots(self, region, snapshot_ids):
+        """Remove deleted snapshots of region from the cache, if any."""
+        if not self.path.exists():
+            return
+
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "DELETE FROM snapshots WHERE region = ? AND id = ?",
+                    ((region, snapshot_id) for snapshot_id in snapshot_ids))
+        finally:
+            conn.close()
+
+    def inventory(self, client, project=None):
+        """Get an Inventory of the client's region from the cache."""
+        region = client.meta.region_name
+        inventory = Inventory(client)
+
+        where, args = "i.region = ?", [region]
+        if project:
+            where, args = where + " AND i.project = ?", args + [project]
+
+        conn = self.connect()
+        try:
+            for row in conn.execute(
+                    "SELECT data FROM instances i WHERE " + where, args):
+                inventory.add_instance(loads(row[0]))
+            for row in conn.execute(
+                    "SELECT v.data FROM instances i JOIN volumes v "
+                    "ON v.region = i.region AND v.instance_id = i.id "
+                    "WHERE " + where, args):
+                inventory.add_volume(loads(row[0]))
+            for row in conn.execute(
+                    "SELECT s.data FROM instances i JOIN volumes v "
+                    "ON v.region = i.region AND v.instance_id = i.id "
+                    "JOIN snapshots s "
+                    "ON s.region = v.region AND s.volume_id = v.id "
+                    "WHERE " + where, args):
+                inventory.add_snapshot(loads(row[0]))
+        finally:
+            conn.close()
+
+        inventory.sort_snapshots()
+        return inventory
+
+    def load(self, client, project=None, max_age=0):
+        """Get an Inventory refreshed at most max_age seconds ago.
+
+        A max_age of 0 always refreshes in full.
+        """
+        conn = self.connect()
+        try:
+            refreshed = self.refreshes(conn, client.meta.region_name)[0]
+        finally:
+            conn.close()
+
+        if refreshed is None or time.time() - refreshed > max_age:
+            self.refresh(client, full=not max_age)
+        return self.inventory(client, project)
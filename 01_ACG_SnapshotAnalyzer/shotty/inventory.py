@@ -0,0 +1,127 @@
+"""Instances, volumes and snapshots of an account, joined in memory."""
+
+# EC2 accepts at most 200 values per filter.
+MAX_FILTER_VALUES = 200
+
+
+def tags_of(item):
+    """Get the tags of an EC2 item as a dict."""
+    return {t['Key']: t['Value'] for t in item.get('Tags') or []}
+
+
+class Inventory:
+    """Instances with their volumes and snapshots.
+
+    Every kind of item is fetched with a single paginated describe
+    call, filtered on the server, and joined through indexes keyed by
+    instance id and volume id. Listing a project therefore takes the
+    same number of calls for 2 instances as for 2,000.
+    """
+
+    def __init__(self, client):
+        """Create an empty Inventory using an EC2 client."""
+        self.client = client
+        self.instances = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.volumes_by_instance = {}
+        self.snapshots_by_volume = {}
+
+    def describe(self, operation, key, filters=(), **kwargs):
+        """Get every item of a paginated describe call."""
+        paginator = self.client.get_paginator(operation)
+        for page in paginator.paginate(Filters=list(filters), **kwargs):
+            if key == 'Reservations':
+                for reservation in page[key]:
+                    yield from reservation['Instances']
+            else:
+                yield from page[key]
+
+    @staticmethod
+    def id_filter(name, ids, fallback):
+        """Filter on ids if they fit in one filter, else on fallback.
+
+        Many ids would take one call per MAX_FILTER_VALUES, so it is
+        cheaper to fetch a little more and drop what does not join.
+        """
+        if len(ids) <= MAX_FILTER_VALUES:
+            return [{'Name': name, 'Values': sorted(ids)}]
+        return fallback
+
+    def load(self, project=None, volumes=True, snapshots=True):
+        """Fetch the instances of project, or all, and what they use."""
+        filters = []
+        if project:
+            filters = [{'Name': 'tag:Project', 'Values': [project]}]
+        for instance in self.describe('describe_instances', 'Reservations',
+                                      filters):
+            self.add_instance(instance)
+
+        if not self.instances or not volumes:
+            return self
+
+        filters = self.id_filter(
+            'attachment.instance-id', self.instances,
+            [{'Name': 'attachment.status', 'Values': ['attached']}])
+        for volume in self.describe('describe_volumes', 'Volumes', filters):
+            self.add_volume(volume)
+
+        if not self.volumes or not snapshots:
+            return self
+
+        filters = self.id_filter('volume-id', self.volumes, [])
+        for snapshot in self.describe('describe_snapshots', 'Snapshots',
+                                      filters, OwnerIds=['self']):
+            self.add_snapshot(snapshot)
+        self.sort_snapshots()
+
+        return self
+
+    def add_instance(self, instance):
+        """Add an instance."""
+        self.instances[instance['InstanceId']] = instance
+        self.volumes_by_instance.setdefault(instance['InstanceId'], [])
+
+    def add_volume(self, volume):
+        """Add a volume attached to a known instance."""
+        for attachment in volume.get('Attachments', []):
+            if attachment['InstanceId'] in self.instances:
+                self.volumes[volume['VolumeId']] = volume
+                self.volumes_by_instance[attachment['InstanceId']].append(
+                    volume)
+                self.snapshots_by_volume.setdefault(volume['VolumeId'], [])
+                return
+
+    def add_snapshot(self, snapshot):
+        """Add a snapshot of a known volume."""
+        snapshots = self.snapshots_by_volume.get(snapshot['VolumeId'])
+        if snapshots is None:
+            return
+        self.snapshots[snapshot['SnapshotId']] = snapshot
+        snapshots.append(snapshot)
+
+    def sort_snapshots(self):
+        """Sort the snapshots of every volume newest first."""
+        for snapshots in self.snapshots_by_volume.values():
+            snapshots.sort(key=lambda s: s['StartTime'], reverse=True)
+
+    def instance_volumes(self):
+        """Get (instance, volume) pairs, in instance order."""
+        return [(instance, volume)
+                for instance in self.instances.values()
+                for volume in self.volumes_by_instance[
+                    instance['InstanceId']]]
+
+    def volume_snapshots(self, list_all=True):
+        """Get (instance, volume, snapshot) triples, newest first.
+
+        Unless list_all, snapshots of a volume stop at the most recent
+        completed one.
+        """
+        rows = []
+        for instance, volume in self.instance_volumes():
+            for snapshot in self.snapshots_by_volume[volume['VolumeId']]:
+                rows.append((instance, volume, snapshot))
+                if snapshot['State'] == 'completed' and not list_all:
+                    break
+        return rows
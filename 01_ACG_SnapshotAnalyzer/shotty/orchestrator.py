@@ -0,0 +1,231 @@
+"""Snapshot many EC2 instances at the same time."""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+DESCRIPTION = "Created by Snapshot analyzer"
+
+
+def instance_volumes(instance):
+    """Get the ids of the EBS volumes attached to instance."""
+    return [m['Ebs']['VolumeId'] for m in instance.block_device_mappings
+            if 'Ebs' in m]
+
+
+def boot_volume(instance):
+    """Get the id of the EBS root volume of instance, if it has one."""
+    for m in instance.block_device_mappings:
+        if m['DeviceName'] == instance.root_device_name and 'Ebs' in m:
+            return m['Ebs']['VolumeId']
+    return None
+
+
+def batch_key(instance, batch_by):
+    """Get the batch of instance for batch_by, 'az' or 'tag:KEY'."""
+    if batch_by == 'az':
+        return instance.placement['AvailabilityZone']
+    tags = {t['Key']: t['Value'] for t in instance.tags or []}
+    return tags.get(batch_by[len('tag:'):], '')
+
+
+class Progress:
+    """Counters of one snapshot run, safe to update from workers."""
+
+    def __init__(self, total):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.total = total
+        self.done = 0
+        self.failed = {}
+        self.snapshots = 0
+        self.skipped = 0
+
+    def add_snapshot(self):
+        with self.lock:
+            self.snapshots += 1
+
+    def add_skipped(self):
+        with self.lock:
+            self.skipped += 1
+
+    def finish(self, instance_id, error=None):
+        """Record that an instance is done, or failed with error."""
+        with self.lock:
+            if error is None:
+                self.done += 1
+            else:
+                self.failed[instance_id] = error
+
+    def summary(self):
+        return ("{} of {} instances done, {} failed in {:.0f}s: "
+                "{} snapshots created, {} volumes skipped").format(
+                    self.done, self.total, len(self.failed),
+                    time.monotonic() - self.started,
+                    self.snapshots, self.skipped)
+
+
+class SnapshotOrchestrator:
+    """Snapshot instances, several at a time.
+
+    All volumes of an instance are snapshotted with one create_snapshots
+    call, which makes crash-consistent snapshots of a running instance.
+    With stop, running instances are stopped first and started again
+    afterwards instead.
+
+    Instances are split into batches by availability zone or by the
+    value of a tag, and batches run one after the other so that with
+    stop only one batch is down at a time. Within a batch up to
+    workers instances are handled at once. An instance that fails does
+    not stop the others, and is started again if it was stopped for the
+    snapshot.
+    """
+
+    def __init__(self, client, workers=1, batch_by=None, pending=(),
+                 log=print, stop=False, exclude_boot=False, tags=None):
+        """Create a SnapshotOrchestrator using an EC2 client.
+
+        Volumes in pending already have a snapshot in progress and are
+        skipped. Snapshots get the tags of their volume and tags, a
+        dict, in the request creating them.
+        """
+        self.client = client
+        self.workers = workers
+        self.batch_by = batch_by
+        self.pending = set(pending)
+        self.log = log
+        self.stop = stop
+        self.exclude_boot = exclude_boot
+        self.tags = dict(tags or {})
+
+    def batches(self, instances):
+        """Split instances into batches, sorted by batch name."""
+        if not self.batch_by:
+            return [('all', list(instances))]
+
+        batches = {}
+        for i in instances:
+            batches.setdefault(batch_key(i, self.batch_by), []).append(i)
+        return sorted(batches.items())
+
+    def wait(self, waiter_name, instance_id):
+        self.client.get_waiter(waiter_name).wait(InstanceIds=[instance_id])
+
+    def select_volumes(self, volume_ids, boot_volume_id, progress):
+        """Get the volumes of one instance to snapshot.
+
+        Returns (volume_ids, exclude_boot, excluded data volume ids),
+        where volume_ids is empty if there is nothing to snapshot.
+        """
+        skipped = [v for v in volume_ids if v in self.pending]
+        for volume_id in skipped:
+            self.log("   Skipping {0}, snapshot already in "
+                     "progress".format(volume_id))
+            progress.add_skipped()
+
+        exclude_boot = self.exclude_boot or boot_volume_id in skipped
+        volume_ids = [v for v in volume_ids if v not in skipped and
+                      not (exclude_boot and v == boot_volume_id)]
+        excluded = [v for v in skipped if v != boot_volume_id]
+        return volume_ids, exclude_boot, excluded
+
+    def create_snapshots(self, instance_id, volume_ids, exclude_boot,
+                         excluded, progress):
+        """Snapshot the volumes of one instance in one request."""
+        spec = {'InstanceId': instance_id, 'ExcludeBootVolume': exclude_boot}
+        if excluded:
+            spec['ExcludeDataVolumeIds'] = excluded
+
+        kwargs = {}
+        if self.tags:
+            kwargs['TagSpecifications'] = [{
+                'ResourceType': 'snapshot',
+                'Tags': [{'Key': k, 'Value': v}
+                         for k, v in sorted(self.tags.items())]
+            }]
+
+        self.log("Creating snapshots of {0}".format(', '.join(volume_ids)))
+        result = self.client.create_snapshots(
+            InstanceSpecification=spec, Description=DESCRIPTION,
+            CopyTagsFromSource='volume', **kwargs)
+        for _ in result['Snapshots']:
+            progress.add_snapshot()
+
+    def snapshot(self, instance_id, volume_ids, boot_volume_id, was_running,
+                 progress):
+        """Snapshot the volumes of one instance.
+
+        An instance with no volumes left to snapshot is not stopped.
+        """
+        volume_ids, exclude_boot, excluded = self.select_volumes(
+            volume_ids, boot_volume_id, progress)
+        if not volume_ids:
+            progress.finish(instance_id)
+            return
+
+        stop = self.stop and was_running
+        try:
+            if stop:
+                self.log("Stopping {0}...".format(instance_id))
+                self.client.stop_instances(InstanceIds=[instance_id])
+                self.wait('instance_stopped', instance_id)
+
+            self.create_snapshots(instance_id, volume_ids, exclude_boot,
+                                  excluded, progress)
+
+            if stop:
+                self.log("Starting {0}...".format(instance_id))
+                self.client.start_instances(InstanceIds=[instance_id])
+                self.wait('instance_running', instance_id)
+        except (BotoCoreError, ClientError) as e:
+            self.fail(instance_id, e, stop, progress)
+            return
+
+        progress.finish(instance_id)
+
+    def fail(self, instance_id, error, stopped, progress):
+        """Record a failed instance, starting it again if stopped."""
+        self.log(" Could not snapshot {0}. {1}".format(instance_id, error))
+        progress.finish(instance_id, error)
+        if stopped:
+            self.restart(instance_id)
+
+    def restart(self, instance_id):
+        """Start an instance again after a failure."""
+        self.log("Restarting {0}...".format(instance_id))
+        try:
+            self.client.start_instances(InstanceIds=[instance_id])
+        except ClientError as e:
+            self.log(" Could not restart {0}. {1}".format(instance_id, e))
+
+    def run(self, instances):
+        """Snapshot all instances and return the Progress of the run."""
+        batches = self.batches(instances)
+        progress = Progress(sum(len(batch) for _, batch in batches))
+
+        for name, batch in batches:
+            if self.batch_by:
+                self.log("Batch {0}: {1} instances".format(
+                    name or '<none>', len(batch)))
+
+            # Read everything needed from the resources before the
+            # workers start, they only use the thread safe client.
+            jobs = [(i.id, instance_volumes(i), boot_volume(i),
+                     i.state['Name'] in ('pending', 'running'))
+                    for i in batch]
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [(pool.submit(self.snapshot, *job, progress), job)
+                           for job in jobs]
+                for future, (instance_id, _, _, was_running) in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.fail(instance_id, e, self.stop and was_running,
+                                  progress)
+
+            self.log(progress.summary())
+
+        return progress
@@ -0,0 +1,99 @@
+"""Run shotty commands against several regions at once."""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+MAX_WORKERS = 8
+
+
+class Regions:
+    """The regions a command runs in, with an EC2 resource for each.
+
+    Resources are created when a region first needs one. Without any
+    region given, only the session's default region is used and output
+    looks as it did before regions could be chosen.
+    """
+
+    def __init__(self, session, names=(), all_regions=False):
+        """Create Regions for names, or every enabled region."""
+        self.session = session
+        self.all_regions = all_regions
+        self.show_region = bool(names) or all_regions
+        self._names = list(names)
+        self.resources = {}
+        self.lock = threading.Lock()
+
+    @property
+    def names(self):
+        """The names of the regions to run in."""
+        if self.all_regions and not self._names:
+            client = self.session.client('ec2')
+            self._names = sorted(r['RegionName']
+                                 for r in client.describe_regions()['Regions'])
+        return self._names or [self.session.region_name]
+
+    def resource(self, name):
+        """Get the EC2 resource of region name."""
+        # Creating clients from one session is not thread safe.
+        with self.lock:
+            if name not in self.resources:
+                self.resources[name] = self.session.resource(
+                    'ec2', region_name=name)
+            return self.resources[name]
+
+    def log_for(self, name):
+        """Get a function printing lines of region name."""
+        def log(line):
+            print(self.prefix(name) + line)
+        return log
+
+    def prefix(self, name):
+        return '{}, '.format(name) if self.show_region else ''
+
+    def run_one(self, work, name):
+        started = time.monotonic()
+        lines = work(self.resource(name), self.log_for(name))
+        return lines or [], time.monotonic() - started
+
+    def run(self, work):
+        """Call work(ec2, log) in every region at the same time.
+
+        work returns lines to print, which are printed as soon as its
+        region is done, each starting with the region when several can
+        be chosen. A region that fails does not stop the others.
+        Returns a dict from region name to seconds taken, or to the
+        error.
+        """
+        names = self.names
+        started = time.monotonic()
+        results = {}
+
+        workers = min(len(names), MAX_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.run_one, work, name): name
+                       for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    lines, results[name] = future.result()
+                except (BotoCoreError, ClientError) as e:
+                    results[name] = e
+                    lines = ["Failed: {}".format(e)]
+                for line in lines:
+                    print(self.prefix(name) + line)
+
+        if self.show_region:
+            self.print_summary(results, time.monotonic() - started)
+        return results
+
+    @staticmethod
+    def print_summary(results, elapsed):
+        print("{} regions in {:.2f}s".format(len(results), elapsed))
+        for name, result in sorted(results.items()):
+            if isinstance(result, Exception):
+                print("  {}: failed".format(name))
+            else:
+                print("  {}: {:.2f}s".format(name, result))
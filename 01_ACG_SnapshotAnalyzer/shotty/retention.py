@@ -0,0 +1,163 @@
+"""Decide which snapshots to keep and delete the others."""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+THROTTLING_ERRORS = {'RequestLimitExceeded', 'Throttling'}
+
+# Periods a snapshot can be kept for, with the key of its period.
+PERIODS = (
+    ('daily', lambda t: t.strftime('%Y-%m-%d')),
+    ('weekly', lambda t: '{}-W{:02}'.format(*t.isocalendar()[:2])),
+    ('monthly', lambda t: t.strftime('%Y-%m')),
+)
+
+
+class RetentionPolicy:
+    """Which snapshots of a volume to keep.
+
+    A snapshot is kept if it is one of the keep_last newest, or the
+    newest of one of the last daily days, weekly weeks or monthly
+    months that have snapshots. Snapshots older than max_age, a
+    timedelta, are not kept even then; with max_age alone, every
+    younger snapshot is kept. The newest completed snapshot and those
+    still in progress are always kept.
+    """
+
+    def __init__(self, keep_last=0, daily=0, weekly=0, monthly=0,
+                 max_age=None):
+        self.keep_last = keep_last
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.max_age = max_age
+
+    def __bool__(self):
+        return bool(self.keep_last or self.daily or self.weekly or
+                    self.monthly or self.max_age)
+
+    def plan(self, snapshots, now=None):
+        """Get (snapshot, keep, reason) for the snapshots of one volume.
+
+        Snapshots are returned newest first.
+        """
+        now = now or datetime.now(timezone.utc)
+        snapshots = sorted(snapshots, key=lambda s: s['StartTime'],
+                           reverse=True)
+        completed = [s for s in snapshots if s['State'] == 'completed']
+
+        reasons = {}
+        for s in completed[:self.keep_last]:
+            reasons[s['SnapshotId']] = 'last {}'.format(self.keep_last)
+
+        for name, period_of in PERIODS:
+            periods = set()
+            for s in completed:
+                if len(periods) >= getattr(self, name):
+                    break
+                period = period_of(s['StartTime'])
+                if period not in periods:
+                    periods.add(period)
+                    reasons.setdefault(s['SnapshotId'],
+                                       '{} {}'.format(name, period))
+
+        too_old = set()
+        if self.max_age:
+            cutoff = now - self.max_age
+            too_old = {s['SnapshotId'] for s in completed
+                       if s['StartTime'] < cutoff}
+            if not (self.keep_last or self.daily or self.weekly or
+                    self.monthly):
+                for s in completed:
+                    if s['SnapshotId'] not in too_old:
+                        reasons[s['SnapshotId']] = 'younger than max age'
+
+        plan = []
+        for s in snapshots:
+            snapshot_id = s['SnapshotId']
+            if s['State'] != 'completed':
+                plan.append((s, True, 'in progress'))
+            elif completed and s is completed[0]:
+                plan.append((s, True, reasons.get(snapshot_id, 'newest')))
+            elif snapshot_id in too_old:
+                plan.append((s, False, 'older than max age'))
+            elif snapshot_id in reasons:
+                plan.append((s, True, reasons[snapshot_id]))
+            else:
+                plan.append((s, False, 'not kept'))
+        return plan
+
+
+class AdaptiveRateLimiter:
+    """Spread calls out, slowing down while AWS throttles them.
+
+    The rate is halved whenever a call is throttled and grows back by
+    step calls per second with every call that succeeds.
+    """
+
+    def __init__(self, rate=5.0, min_rate=0.5, max_rate=20.0, step=0.1):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = step
+        self.next_call = time.monotonic()
+
+    def acquire(self):
+        """Wait until the next call may be made."""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0, self.next_call - now)
+            self.next_call = max(now, self.next_call) + 1 / self.rate
+        time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+
+class SnapshotPruner:
+    """Delete snapshots concurrently under an AdaptiveRateLimiter."""
+
+    def __init__(self, client, limiter=None, workers=4, max_attempts=8):
+        self.client = client
+        self.limiter = limiter or AdaptiveRateLimiter()
+        self.workers = workers
+        self.max_attempts = max_attempts
+
+    def delete(self, snapshot_id):
+        """Delete a snapshot, returning an error message if it fails."""
+        for _ in range(self.max_attempts):
+            self.limiter.acquire()
+            try:
+                self.client.delete_snapshot(SnapshotId=snapshot_id)
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code in THROTTLING_ERRORS:
+                    self.limiter.throttled()
+                    continue
+                if code == 'InvalidSnapshot.NotFound':
+                    return None
+                return str(e)
+
+            self.limiter.succeeded()
+            return None
+
+        return "still throttled after {} attempts".format(self.max_attempts)
+
+    def run(self, snapshot_ids):
+        """Delete snapshot_ids, returning a dict of failures by id."""
+        snapshot_ids = list(snapshot_ids)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            errors = pool.map(self.delete, snapshot_ids)
+            return {snapshot_id: error
+                    for snapshot_id, error in zip(snapshot_ids, errors)
+                    if error}
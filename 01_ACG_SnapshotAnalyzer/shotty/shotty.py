@@ -1,12 +1,26 @@
+from datetime import timedelta
+from pathlib import Path
+import sys
+
+if not __package__:
+    # Run as a script: find the shotty package, not this file, when
+    # importing its modules below.
+    sys.path[0] = str(Path(__file__).resolve().parent.parent)
+
 import boto3
 import botocore
 import click
 
-session = boto3.Session(profile_name='default')
-ec2 = session.resource('ec2')
+from shotty.cache import InventoryCache
+from shotty.inventory import MAX_FILTER_VALUES, Inventory, tags_of
+from shotty.orchestrator import (
+    DESCRIPTION, SnapshotOrchestrator, instance_volumes)
+from shotty.regions import Regions
+from shotty.retention import (
+    AdaptiveRateLimiter, RetentionPolicy, SnapshotPruner)
 
 
-def filter_instances(project):
+def filter_instances(ec2, project):
     instances = []
     if project:
         filters = [{'Name': 'tag:Project', 'Values': [project]}]
@@ -15,13 +29,43 @@ def filter_instances(project):
         instances = ec2.instances.all()
     return instances
 
-def has_pending_snapshots(volume):
-    snapshots = list(volume.snapshots.all())
-    return snapshots and snapshots[0].state == 'pending'
+def pending_snapshot_volumes(ec2, volume_ids):
+    """Get the ids of the volumes that have a snapshot in progress."""
+    volume_ids = sorted(set(volume_ids))
+    pending = set()
+    paginator = ec2.meta.client.get_paginator('describe_snapshots')
+    for start in range(0, len(volume_ids), MAX_FILTER_VALUES):
+        filters = [
+            {'Name': 'volume-id',
+             'Values': volume_ids[start:start + MAX_FILTER_VALUES]},
+            {'Name': 'status', 'Values': ['pending']}
+        ]
+        for page in paginator.paginate(OwnerIds=['self'], Filters=filters):
+            pending.update(s['VolumeId'] for s in page['Snapshots'])
+    return pending
+
+def load_inventory(ec2, project, max_age, **kwargs):
+    """Get the inventory of project, from the cache if max_age is set."""
+    if max_age is None:
+        return Inventory(ec2.meta.client).load(project, **kwargs)
+    return InventoryCache().load(ec2.meta.client, project, max_age)
+
+def max_age_option(command):
+    return click.option('--max-age', default=None,
+        type=click.IntRange(min=0),
+        help="Serve from the local cache if it was refreshed at most "
+             "this many seconds ago, else refresh it first.")(command)
 
 @click.group()
-def cli():
+@click.option('--region', 'regions', multiple=True,
+    help="Run in this region instead of the default one. May be repeated.")
+@click.option('--all-regions', is_flag=True,
+    help="Run in every region enabled for the account.")
+@click.pass_context
+def cli(ctx, regions, all_regions):
     """Shotty manages snapshots"""
+    session = boto3.Session(profile_name='default')
+    ctx.obj = Regions(session, regions, all_regions)
 
 @cli.group('snapshots')
 def snapshots():
@@ -38,104 +82,244 @@ def volumes():
 
 @instances.command('list')
 @click.option('--project', default=None)
-def list_instances(project):
+@max_age_option
+@click.pass_obj
+def list_instances(regions, project, max_age):
     "List EC2 instances"
-    for i in filter_instances(project):
-        tags = { t['Key'] : t['Value'] for t in i.tags or [] }
-        print(', '.join((
-            i.id,
-            i.instance_type,
-            i.placement['AvailabilityZone'],
-            i.state['Name'],
-            i.public_dns_name,
-            tags.get('Project', '<no project>'))))
+    def work(ec2, log):
+        inventory = load_inventory(ec2, project, max_age, volumes=False)
+        return [', '.join((
+            i['InstanceId'],
+            i['InstanceType'],
+            i['Placement']['AvailabilityZone'],
+            i['State']['Name'],
+            i.get('PublicDnsName', ''),
+            tags_of(i).get('Project', '<no project>')))
+            for i in inventory.instances.values()]
+
+    regions.run(work)
     return
 
 @instances.command('start')
 @click.option('--project', default=None)
-def start_instances(project):
+@click.pass_obj
+def start_instances(regions, project):
     "Start EC2 instances"
 
-    for i in filter_instances(project):
-        print("Starting {0} ...".format(i.id))
-        try:
-            i.start()
-        except botocore.exceptions.ClientError as e:
-            print(" Could not start {0}.".format(i.id) + str(e))
-            continue
+    def work(ec2, log):
+        lines = []
+        for i in filter_instances(ec2, project):
+            lines.append("Starting {0} ...".format(i.id))
+            try:
+                i.start()
+            except botocore.exceptions.ClientError as e:
+                lines.append(" Could not start {0}.".format(i.id) + str(e))
+                continue
+        return lines
+
+    regions.run(work)
     return
 
 @instances.command('stop')
 @click.option('--project', default=None)
-def stop_instances(project):
+@click.pass_obj
+def stop_instances(regions, project):
     "Stop EC2 instances"
 
-    for i in filter_instances(project):
-        print("Stop {0} ...".format(i.id))
-        try:
-            i.stop()
-        except botocore.exceptions.ClientError as e:
-            print(" Could not stop {0}.".format(i.id) + str(e))
-            continue
+    def work(ec2, log):
+        lines = []
+        for i in filter_instances(ec2, project):
+            lines.append("Stop {0} ...".format(i.id))
+            try:
+                i.stop()
+            except botocore.exceptions.ClientError as e:
+                lines.append(" Could not stop {0}.".format(i.id) + str(e))
+                continue
+        return lines
+
+    regions.run(work)
     return
 
+def check_batch_by(ctx, param, value):
+    if value and value != 'az' and not value.startswith('tag:'):
+        raise click.BadParameter("expected 'az' or 'tag:KEY'")
+    return value
+
+def parse_tags(ctx, param, value):
+    tags = {}
+    for tag in value:
+        key, sep, tag_value = tag.partition('=')
+        if not sep or not key:
+            raise click.BadParameter("expected KEY=VALUE, got " + tag)
+        tags[key] = tag_value
+    return tags
+
 @instances.command('snapshot')
 @click.option('--project', default=None)
-def snapshot_instances(project):
+@click.option('--workers', default=1, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of instances to snapshot at the same time.")
+@click.option('--batch-by', default=None, callback=check_batch_by,
+    help="Snapshot instances in batches by 'az' or by the value of "
+         "'tag:KEY', one batch at a time.")
+@click.option('--stop', is_flag=True,
+    help="Stop running instances for the snapshot and start them "
+         "again afterwards, instead of snapshotting them online.")
+@click.option('--exclude-boot-volume', is_flag=True,
+    help="Do not snapshot the root volume of instances.")
+@click.option('--tag', 'tags', multiple=True, metavar='KEY=VALUE',
+    callback=parse_tags,
+    help="Tag the snapshots with KEY=VALUE. May be repeated.")
+@click.pass_obj
+def snapshot_instances(regions, project, workers, batch_by, stop,
+                       exclude_boot_volume, tags):
     "Snapshot instances"
-    for i in filter_instances(project):
-        print("Stopping {0}...".format(i.id))
-        i.stop()
-        i.wait_until_stopped()
-        for v in i.volumes.all():
-            if has_pending_snapshot(v):
-                print("   Skipping {0}, snapshot already in progress".format(v.id))
-                continue
-
-            print("Creating snapshot of {0}".format(v.id))
-            v.create_snapshot(Description="Created by Snapshot analyzer")
+    def work(ec2, log):
+        instances = list(filter_instances(ec2, project))
+        pending = pending_snapshot_volumes(
+            ec2, (v for i in instances for v in instance_volumes(i)))
 
-        print("Starting {0}...".format(i.id))
-        i.start()
-        i.wait_until_running()
+        orchestrator = SnapshotOrchestrator(
+            ec2.meta.client, workers, batch_by, pending, log, stop,
+            exclude_boot_volume, tags)
+        progress = orchestrator.run(instances)
+        return ["Failed {0}: {1}".format(instance_id, error)
+                for instance_id, error in progress.failed.items()]
 
+    regions.run(work)
     print("Job's done!")
 
     return
 
 @volumes.command('list')
 @click.option('--project', default=None)
-def list_volumes(project):
+@max_age_option
+@click.pass_obj
+def list_volumes(regions, project, max_age):
     "List of volumes"
-    for i in filter_instances(project):
-        for v in i.volumes.all():
-            print(", ".join((
-                v.id,
-                i.id,
-                v.state,
-                str(v.size) + "GiB",
-                v.encrypted and "Encrypted" or "Not Encrypted"
-            )))
+    def work(ec2, log):
+        inventory = load_inventory(ec2, project, max_age, snapshots=False)
+        return [", ".join((
+            v['VolumeId'],
+            i['InstanceId'],
+            v['State'],
+            str(v['Size']) + "GiB",
+            v['Encrypted'] and "Encrypted" or "Not Encrypted"
+        )) for i, v in inventory.instance_volumes()]
+
+    regions.run(work)
     return
 
 @snapshots.command('list')
 @click.option('--project', default=None)
 @click.option('--all', 'list_all', default=False, is_flag=True)
-def list_snapshots(project, list_all):
+@max_age_option
+@click.pass_obj
+def list_snapshots(regions, project, list_all, max_age):
     "List of Snapshots"
-    for i in filter_instances(project):
-        for v in i.volumes.all():
-            for s in v.snapshots.all():
-                print(", ".join((
-                    s.id,
-                    v.id,
-                    i.id,
-                    v.state,
-                    s.progress,
-                    s.start_time.strftime("%C")
-            )))
-
-            if s.state == 'completed' and not list_all: break
+    def work(ec2, log):
+        inventory = load_inventory(ec2, project, max_age)
+        return [", ".join((
+            s['SnapshotId'],
+            v['VolumeId'],
+            i['InstanceId'],
+            v['State'],
+            s.get('Progress', ''),
+            s['StartTime'].strftime("%c")
+        )) for i, v, s in inventory.volume_snapshots(list_all)]
+
+    regions.run(work)
+    return
+
+def prunable_snapshots(ec2, project, include_all):
+    """Get the snapshots prune may delete, in one bulk listing.
+
+    Unless include_all, only snapshots created by shotty are included.
+    """
+    inventory = Inventory(ec2.meta.client)
+    if project:
+        snapshots = inventory.load(project).snapshots.values()
+    else:
+        filters = []
+        if not include_all:
+            filters = [{'Name': 'description', 'Values': [DESCRIPTION]}]
+        snapshots = inventory.describe('describe_snapshots', 'Snapshots',
+                                       filters, OwnerIds=['self'])
+    return [s for s in snapshots
+            if include_all or s.get('Description') == DESCRIPTION]
+
+@snapshots.command('prune')
+@click.option('--project', default=None)
+@click.option('--keep-last', default=0, type=click.IntRange(min=0),
+    help="Keep the N newest snapshots of every volume.")
+@click.option('--daily', default=0, type=click.IntRange(min=0),
+    help="Keep the newest snapshot of each of the last N days.")
+@click.option('--weekly', default=0, type=click.IntRange(min=0),
+    help="Keep the newest snapshot of each of the last N weeks.")
+@click.option('--monthly', default=0, type=click.IntRange(min=0),
+    help="Keep the newest snapshot of each of the last N months.")
+@click.option('--max-age-days', default=None, type=click.IntRange(min=1),
+    help="Delete snapshots older than N days, even if kept otherwise.")
+@click.option('--all', 'include_all', is_flag=True,
+    help="Also prune snapshots that were not created by shotty.")
+@click.option('--workers', default=4, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of snapshots to delete at the same time.")
+@click.option('--rate', default=5.0, show_default=True,
+    type=click.FloatRange(min=0.5),
+    help="Deletes per second to start with; halved when throttled.")
+@click.option('--dry-run', is_flag=True,
+    help="Only show what would be kept and deleted.")
+@click.pass_obj
+def prune_snapshots(regions, project, keep_last, daily, weekly, monthly,
+                    max_age_days, include_all, workers, rate, dry_run):
+    "Delete snapshots not kept by a retention policy"
+    policy = RetentionPolicy(
+        keep_last, daily, weekly, monthly,
+        max_age_days and timedelta(days=max_age_days))
+    if not policy:
+        raise click.UsageError("Give at least one retention rule.")
+
+    def work(ec2, log):
+        by_volume = {}
+        for s in prunable_snapshots(ec2, project, include_all):
+            by_volume.setdefault(s['VolumeId'], []).append(s)
+
+        lines = []
+        deletes = []
+        for volume_id, volume_snapshots in sorted(by_volume.items()):
+            for s, keep, reason in policy.plan(volume_snapshots):
+                if not keep:
+                    deletes.append(s['SnapshotId'])
+                if dry_run or not keep:
+                    lines.append(", ".join((
+                        keep and "keep" or "delete",
+                        s['SnapshotId'],
+                        volume_id,
+                        s['StartTime'].strftime("%c"),
+                        reason
+                    )))
+
+        kept = sum(len(v) for v in by_volume.values()) - len(deletes)
+        if dry_run:
+            lines.append("Would delete {0} snapshots and keep {1}".format(
+                len(deletes), kept))
+            return lines
+
+        pruner = SnapshotPruner(ec2.meta.client,
+                                AdaptiveRateLimiter(rate), workers)
+        failed = pruner.run(deletes)
+        InventoryCache().evict_snapshots(
+            ec2.meta.client.meta.region_name,
+            [snapshot_id for snapshot_id in deletes
+             if snapshot_id not in failed])
+        lines += [" Could not delete {0}. {1}".format(snapshot_id, error)
+                  for snapshot_id, error in sorted(failed.items())]
+        lines.append("Deleted {0} snapshots, kept {1}, {2} failed".format(
+            len(deletes) - len(failed), kept, len(failed)))
+        return lines
+
+    regions.run(work)
     return
 
 if __name__ == '__main__':
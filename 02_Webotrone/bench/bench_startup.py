@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Check webotron CLI startup against a time budget.
+
+Runs 'webotron.py --help' several times in fresh interpreters and
+compares the median wall time with the budget. Also checks that
+importing the CLI does not import boto3 or botocore, since AWS clients
+are meant to be created only when a command needs them. Exits with
+status 1 when the budget is exceeded, so it can run in CI.
+"""
+
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+WEBOTRON_DIR = Path(__file__).resolve().parent.parent / 'webotron'
+
+IMPORT_CHECK = """
+import sys
+import webotron
+heavy = [m for m in ('boto3', 'botocore') if m in sys.modules]
+print(','.join(heavy))
+"""
+
+
+def time_help(runs):
+    """Get the wall time of each of runs 'webotron.py --help' calls."""
+    times = []
+    for _ in range(runs):
+        started = time.monotonic()
+        subprocess.run([sys.executable, 'webotron.py', '--help'],
+                       cwd=str(WEBOTRON_DIR), check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.monotonic() - started)
+    return times
+
+
+def heavy_imports():
+    """Get the heavy modules imported by importing the CLI."""
+    output = subprocess.run([sys.executable, '-c', IMPORT_CHECK],
+                            cwd=str(WEBOTRON_DIR), check=True,
+                            stdout=subprocess.PIPE).stdout.decode().strip()
+    return [m for m in output.split(',') if m]
+
+
+@click.command()
+@click.option('--runs', default=5, show_default=True)
+@click.option('--budget', default=0.25, show_default=True,
+    help="Allowed median seconds for 'webotron.py --help'.")
+def main(runs, budget):
+    """Measure webotron startup and fail if it is over BUDGET."""
+    times = time_help(runs)
+    median = statistics.median(times)
+    heavy = heavy_imports()
+
+    print("--help: median {:.3f}s, min {:.3f}s, max {:.3f}s "
+          "(budget {:.3f}s)".format(median, min(times), max(times), budget))
+    if heavy:
+        print("Importing webotron imports {}".format(', '.join(heavy)))
+
+    if median > budget or heavy:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmark webotron sync against a local S3 stand-in.
+
+Generates synthetic site trees and syncs each of them to a moto mocked
+bucket three times: cold (empty bucket, no ETag cache), warm (nothing
+changed) and with 1% of the files changed. For every run it records
+wall time, API calls per operation, bytes hashed and peak RSS, and
+writes the results as JSON so runs of different commits can be
+compared with --compare.
+
+Needs moto (pip install moto) on top of webotron's dependencies.
+"""
+
+from pathlib import Path
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'webotron'))
+
+import boto3
+from bucket import BucketManager
+
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_s3 as mock_aws
+
+BUCKET_NAME = 'webotron-bench'
+
+# name: (files, file size, directory depth)
+PROFILES = {
+    'tiny': (5000, 1024, 3),
+    'huge': (3, 64 * 1024 * 1024, 1),
+    'deep': (500, 4096, 20),
+}
+
+
+class CountingBucketManager(BucketManager):
+    """BucketManager that counts the bytes it hashes."""
+
+    def __init__(self, session):
+        """Create a CountingBucketManager that caches nothing on disk."""
+        super().__init__(session, cache_ttl=0)
+        self.lock = threading.Lock()
+        self.hashed_bytes = 0
+
+    def count(self, path):
+        """Add the size of path to the hashed bytes."""
+        size = os.stat(path).st_size
+        with self.lock:
+            self.hashed_bytes += size
+
+    def gen_etag(self, path):
+        """Generate etag for file and count its bytes."""
+        self.count(path)
+        return super().gen_etag(path)
+
+    def gen_compressed_etag(self, path, encoding):
+        """Generate etag for compressed file and count its bytes."""
+        self.count(path)
+        return super().gen_compressed_etag(path, encoding)
+
+
+class ApiCallCounter:
+    """Count API calls made through a boto3 session."""
+
+    def __init__(self, session):
+        """Create an ApiCallCounter and hook it into session."""
+        self.lock = threading.Lock()
+        self.calls = {}
+        session.events.register('before-call', self.on_call)
+
+    def on_call(self, event_name, **kwargs):
+        """Count one call of the operation named in event_name."""
+        operation = event_name.split('.', 1)[1]
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def reset(self):
+        """Forget all counted calls."""
+        with self.lock:
+            calls, self.calls = self.calls, {}
+        return calls
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process where Linux allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_kb():
+    """Get the peak RSS of this process in KiB."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def make_tree(root, files, size, depth, seed=0):
+    """Generate files of size bytes spread over depth directory levels."""
+    rng = random.Random(seed)
+    old = time.time() - 3600
+    paths = []
+    for i in range(files):
+        parts = ['d{}'.format(rng.randrange(10)) for _ in range(depth - 1)]
+        path = root.joinpath(*parts, 'f{}.html'.format(i))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(size))
+        os.utime(str(path), (old, old))
+        paths.append(path)
+    return paths
+
+
+def change_files(paths, fraction, seed=1):
+    """Change fraction of the files, keeping them old enough to cache."""
+    rng = random.Random(seed)
+    changed = rng.sample(paths, max(1, int(len(paths) * fraction)))
+    old = time.time() - 1800
+    for path in changed:
+        with path.open('ab') as f:
+            f.write(b'changed')
+        os.utime(str(path), (old, old))
+    return len(changed)
+
+
+def run_sync(session, counter, root, options):
+    """Sync root once and measure it."""
+    manager = CountingBucketManager(session)
+    counter.reset()
+    reset_peak_rss()
+    started = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, stats = manager.sync(str(root), BUCKET_NAME, **options)
+    wall = time.monotonic() - started
+
+    return {
+        'wall_s': round(wall, 4),
+        'api_calls': counter.reset(),
+        'bytes_hashed': manager.hashed_bytes,
+        'peak_rss_kb': peak_rss_kb(),
+        'files': stats.files,
+        'uploaded': stats.uploaded,
+        'skipped': stats.skipped,
+    }
+
+
+def bench_profile(name, scale, options):
+    """Run the cold, warm and 1% changed syncs for one profile."""
+    files, size, depth = PROFILES[name]
+    files = max(1, int(files * scale))
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp, mock_aws():
+        root = Path(tmp) / name
+        paths = make_tree(root, files, size, depth)
+
+        session = boto3.Session(region_name='us-east-1')
+        counter = ApiCallCounter(session)
+        session.client('s3').create_bucket(Bucket=BUCKET_NAME)
+
+        results['cold'] = run_sync(session, counter, root, options)
+        results['warm'] = run_sync(session, counter, root, options)
+        change_files(paths, 0.01)
+        results['changed_1pct'] = run_sync(session, counter, root, options)
+
+    return results
+
+
+def git_commit():
+    """Get the commit being benchmarked, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=str(Path(__file__).resolve().parent),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Print wall time changes between two result files."""
+    for name, runs in new['profiles'].items():
+        for run, result in runs.items():
+            before = old['profiles'].get(name, {}).get(run)
+            if not before:
+                continue
+            print("{:6} {:13} {:9.3f}s -> {:9.3f}s ({:+.1f}%)".format(
+                name, run, before['wall_s'], result['wall_s'],
+                100.0 * (result['wall_s'] - before['wall_s'])
+                / (before['wall_s'] or 1e-9)))
+
+
+@click.command()
+@click.option('--profile', 'profiles', multiple=True,
+    type=click.Choice(sorted(PROFILES)),
+    help="Profiles to run, all by default. May be repeated.")
+@click.option('--scale', default=1.0, show_default=True,
+    help="Multiply the number of files of each profile.")
+@click.option('--workers', default=1, show_default=True)
+@click.option('--listing-workers', default=1, show_default=True)
+@click.option('--hash-processes', default=1, show_default=True)
+@click.option('--compress', default=None, type=click.Choice(['gzip', 'br']))
+@click.option('--output', default='bench_sync.json', show_default=True,
+    type=click.Path(dir_okay=False))
+@click.option('--compare', 'baseline', default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Earlier results to compare wall times with.")
+def main(profiles, scale, workers, listing_workers, hash_processes,
+         compress, output, baseline):
+    """Benchmark webotron sync and write the results to OUTPUT."""
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+    options = {
+        'workers': workers,
+        'listing_workers': listing_workers,
+        'hash_processes': hash_processes,
+        'compress': compress,
+    }
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'options': options,
+        'scale': scale,
+        'profiles': {},
+    }
+
+    for name in profiles or sorted(PROFILES):
+        print("Running {}...".format(name))
+        results['profiles'][name] = bench_profile(name, scale, options)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(output))
+
+    if baseline:
+        with open(baseline) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
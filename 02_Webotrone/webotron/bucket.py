@@ -3,39 +3,225 @@
 """Classes for S3 Buckets."""
 
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import io
+import multiprocessing
+import os
+import threading
+import time
 
 import util
+import hashing
+import compression
+from cache import DEFAULT_TTL, DiskCache
+from etagcache import ETagCache
+from manifest import Manifest, pack_etag
+import plan
 import mimetypes
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from hashlib import md5
-from functools import reduce
+
+
+class SyncStats:
+    """Counters for a single sync run, safe to update from workers."""
+
+    def __init__(self):
+        """Create a SyncStats object and start the clock."""
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.finished = None
+        self.files = 0
+        self.bytes = 0
+        self.uploaded = 0
+        self.updated = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.changed_keys = []
+
+    def add(self, size, uploaded, key=None):
+        """Record one processed file of size bytes."""
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            if uploaded:
+                self.uploaded += 1
+                if key is not None:
+                    self.changed_keys.append(key)
+            else:
+                self.skipped += 1
+
+    def add_updated(self, size, key):
+        """Record one file whose headers were updated in place."""
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            self.updated += 1
+            self.changed_keys.append(key)
+
+    def add_deleted(self, count, keys=()):
+        """Record count deleted keys."""
+        with self.lock:
+            self.deleted += count
+            self.changed_keys.extend(keys)
+
+    def stop(self):
+        """Stop the clock."""
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self):
+        """Seconds spent so far, or in total once stopped."""
+        return (self.finished or time.monotonic()) - self.started
+
+    def summary(self):
+        """Human readable throughput report."""
+        elapsed = self.elapsed or 1e-9
+        return ("Synced {} files ({} bytes) in {:.2f}s: "
+                "{:.1f} files/s, {:.0f} bytes/s "
+                "({} uploaded, {} updated, {} skipped, {} deleted)").format(
+                    self.files, self.bytes, elapsed,
+                    self.files / elapsed, self.bytes / elapsed,
+                    self.uploaded, self.updated, self.skipped,
+                    self.deleted)
 
 class BucketManager:
     """Manages an S3 Bucket."""
 
     CHUNK_SIZE = 8388608
-
-    def __init__(self, session):
-        """Create a BucketManager object"""
-        
+    DELETE_BATCH_SIZE = 1000
+
+    # Files of at least min size are uploaded in parts of part size
+    # with max concurrency threads: (min size, part size, concurrency).
+    TRANSFER_CLASSES = (
+        (0, CHUNK_SIZE, 10),
+        (512 * 1024**2, 32 * 1024**2, 16),
+        (4 * 1024**3, 128 * 1024**2, 16),
+    )
+
+    def __init__(self, session, cache_ttl=DEFAULT_TTL):
+        """Create a BucketManager object.
+
+        Bucket regions are remembered for the session and cached on
+        disk for cache_ttl seconds; 0 disables the disk cache.
+        """
         self.session = session
+        self.regions = None
+        self.regions_lock = threading.Lock()
+        self.regions_cache = DiskCache.for_session(
+            session, 's3-regions', cache_ttl)
         self.s3 = session.resource('s3')
-        self.transfer_config = boto3.s3.transfer.TransferConfig(
-            multipart_chunksize=self.CHUNK_SIZE,
-            multipart_threshold=self.CHUNK_SIZE
-        )
-        self.manifest = {}
+        self.watch_regions(self.s3.meta.client)
+        self.clients = {}
+        self.set_transfer_classes(self.TRANSFER_CLASSES)
+        self.manifest = None
+        self.hash_pool = None
+        self.hash_processes = 1
+        self.encoding = None
+        self.cache_control = {}
+        self.etag_cache = None
+
+    def set_transfer_classes(self, classes):
+        """Set how files are uploaded depending on their size.
+
+        classes is a list of (min size, part size, max concurrency)
+        tuples. Files smaller than the part size of their class are
+        uploaded in one request.
+        """
+        transfer_classes = sorted(
+            (min_size, boto3.s3.transfer.TransferConfig(
+                multipart_chunksize=part_size,
+                multipart_threshold=part_size,
+                max_concurrency=concurrency))
+            for min_size, part_size, concurrency in classes)
+        if not transfer_classes or transfer_classes[0][0] > 0:
+            raise ValueError("Transfer classes must start at size 0")
+
+        self.transfer_classes = transfer_classes
+
+    def get_transfer_config(self, size):
+        """Get the TransferConfig to upload size bytes with."""
+        config = self.transfer_classes[0][1]
+        for min_size, class_config in self.transfer_classes:
+            if size < min_size:
+                break
+            config = class_config
+        return config
 
     def get_bucket(self, bucket_name):
         """Get a bucket by name."""
         return self.s3.Bucket(bucket_name)
 
+    def watch_regions(self, client):
+        """Remember the bucket regions S3 reports to client.
+
+        The hooks are registered on the client rather than the shared
+        session, so they go away with the client.
+        """
+        client.meta.events.register('provide-client-params.s3',
+                                    self._note_bucket)
+        client.meta.events.register('after-call.s3', self._note_region)
+        return client
+
+    @staticmethod
+    def _note_bucket(params, context, **kwargs):
+        """Remember which bucket an S3 call is for."""
+        if 'Bucket' in params:
+            context['webotron_bucket'] = params['Bucket']
+
+    def _note_region(self, parsed, context, **kwargs):
+        """Record the region S3 reports for the bucket of a call."""
+        bucket_name = context.get('webotron_bucket')
+        headers = parsed.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        region = headers.get('x-amz-bucket-region')
+        if bucket_name and region:
+            self.set_region_name(bucket_name, region)
+
+    def _load_regions(self):
+        """Load the known bucket regions, from disk if cached."""
+        if self.regions is None:
+            regions = self.regions_cache and self.regions_cache.load()
+            self.regions = regions or {}
+        return self.regions
+
+    def set_region_name(self, bucket_name, region):
+        """Remember that bucket_name is in region."""
+        with self.regions_lock:
+            regions = self._load_regions()
+            if regions.get(bucket_name) == region:
+                return
+            regions[bucket_name] = region
+            if self.regions_cache:
+                self.regions_cache.save(regions)
+
     def get_region_name(self, bucket):
-        """Get the bucket's region name."""
-        bucket_location = self.s3.meta.client.get_bucket_location(Bucket=bucket.name)
+        """Get the bucket's region name.
+
+        The region S3 reports in the headers of any call on the bucket
+        is remembered, so it is usually known without another request.
+        Otherwise a HeadBucket call reports it, and GetBucketLocation
+        is only used if that does not.
+        """
+        with self.regions_lock:
+            region = self._load_regions().get(bucket.name)
+        if region:
+            return region
 
-        return bucket_location["LocationConstraint"] or 'us-east-1'
+        try:
+            self.s3.meta.client.head_bucket(Bucket=bucket.name)
+        except ClientError:
+            pass
+
+        with self.regions_lock:
+            region = self.regions.get(bucket.name)
+        if region:
+            return region
+
+        bucket_location = self.s3.meta.client.get_bucket_location(
+            Bucket=bucket.name)
+        region = bucket_location["LocationConstraint"] or 'us-east-1'
+        self.set_region_name(bucket.name, region)
+        return region
 
 
     def get_bucket_url(self, bucket):
@@ -104,78 +290,439 @@ class BucketManager:
             }
         })
 
-    def load_manifest(self, bucket):
-        """Load manifest for caching purposes."""
+    def load_manifest(self, bucket, workers=1):
+        """Start loading manifest for caching purposes.
 
-        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket.name):
-            for obj in page.get('Contents', []):
-                self.manifest[obj['Key']] = obj['ETag']
+        The bucket is listed in the background; lookups wait only until
+        the listing has got as far as the key they ask for. With
+        workers > 1 top level prefixes are listed in parallel.
+        """
+        self.manifest = Manifest(self.s3.meta.client, bucket.name)
+        return self.manifest.start(workers)
 
-    @staticmethod
-    def hash_data(data):
-        """Generate md5 hash for the data"""
+    def gen_etag(self, path):
+        """Generate etag for file
+
+        Large files are hashed on several cores while a hash pool is
+        running, see start_hash_pool.
+        """
+        config = self.get_transfer_config(os.stat(path).st_size)
+        return hashing.file_etag(path, config.multipart_chunksize,
+                                 config.multipart_threshold,
+                                 self.hash_pool, self.hash_processes)
+
+    def start_hash_pool(self, processes):
+        """Hash large files with a pool of processes.
+
+        The workers are not forked from this process, whose listing and
+        upload threads may hold locks at the time.
+        """
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+        self.hash_processes = processes
+        self.hash_pool = ProcessPoolExecutor(max_workers=processes,
+                                             mp_context=context)
+
+    def stop_hash_pool(self):
+        """Shut down the pool started by start_hash_pool."""
+        if self.hash_pool:
+            self.hash_pool.shutdown()
+        self.hash_pool = None
+        self.hash_processes = 1
+
+    def get_client(self, workers=1):
+        """Get an S3 client whose connection pool fits workers uploads.
+
+        Every worker may run a multipart upload with up to
+        max_concurrency threads, so the pool is sized for all of them.
+        The default client is reused when it is already big enough, and
+        bigger clients are kept for the next call.
+        """
+        client = self.s3.meta.client
+        pool_size = workers * max(
+            config.max_concurrency for _, config in self.transfer_classes)
+        if pool_size <= client.meta.config.max_pool_connections:
+            return client
+
+        if pool_size not in self.clients:
+            self.clients[pool_size] = self.watch_regions(self.session.client(
+                's3', config=Config(max_pool_connections=pool_size)))
+        return self.clients[pool_size]
+
+    def gen_compressed_etag(self, path, encoding):
+        """Generate etag for file as uploaded with encoding."""
+        data = compression.compress_file(path, encoding)
+        config = self.get_transfer_config(len(data))
+        return hashing.data_etag(data, config.multipart_chunksize,
+                                 config.multipart_threshold)
+
+    def get_etag(self, path, key, cache=None, encoding=None):
+        """Get etag for file, reusing the cached one while it is valid.
+
+        Cache entries are tied to the part size of the file's transfer
+        class, so they are invalidated when that part size changes.
+        """
+        if cache is not None:
+            st = os.stat(path)
+            part_size = self.get_transfer_config(
+                st.st_size).multipart_chunksize
+            etag = cache.get(key, st, part_size, encoding)
+            if etag is not None:
+                return etag
+
+        if encoding:
+            etag = self.gen_compressed_etag(path, encoding)
+        else:
+            etag = self.gen_etag(path)
 
-        hash = md5()
-        hash.update(data)
+        if cache is not None:
+            cache.put(key, st, part_size, etag, encoding)
 
-        return hash
+        return etag
 
-    def gen_etag(self, path):
-        """Generate etag for file"""
-
-        hashes = []
-        
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(self.CHUNK_SIZE)
-
-                if not data:
-                    break
-
-                hashes.append(self.hash_data(data))
-        
-        if not hashes:
-            return
-        elif len(hashes) == 1:
-            return '"{}"'.format(hashes[0].hexdigest())
-        else:
-            hash = self.hash_data(reduce(lambda x,y: x + y, (h.digest() for h in hashes)))
-            return '"{}-{}"'.format(hash.hexdigest(), len(hashes))
+    def get_encoding(self, content_type, file_encoding=None, size=0):
+        """Get the Content-Encoding to upload a file with.
 
+        content_type and file_encoding are as guessed by mimetypes.
+        """
+        if self.encoding and compression.is_compressible(
+                content_type, file_encoding, size):
+            return self.encoding
+        return None
 
-    def upload_file(self, bucket, path, key):
-        content_type = mimetypes.guess_type(key)[0] or 'text/plain'
+    def get_extra_args(self, change):
+        """Get the ExtraArgs to upload change with."""
+        extra_args = {
+            'ContentType': change.content_type
+        }
+        if change.content_encoding:
+            extra_args['ContentEncoding'] = change.content_encoding
+        if change.cache_control:
+            extra_args['CacheControl'] = change.cache_control
+
+        return extra_args
+
+    def has_cache_control(self, bucket_name, key, cache_control,
+                          cache=None):
+        """Return True if key was uploaded with cache_control.
+
+        The Cache-Control keys were uploaded with is remembered in the
+        ETag cache. Keys it does not know are assumed to have none, and
+        S3 is only asked when that does not match cache_control.
+        """
+        uploaded = None
+        if cache is not None:
+            uploaded = cache.get_cache_control(bucket_name, key)
+        if uploaded == cache_control:
+            return True
+
+        uploaded = self.s3.meta.client.head_object(
+            Bucket=bucket_name, Key=key).get('CacheControl')
+        if cache is not None:
+            cache.put_cache_control(bucket_name, key, uploaded)
+        return uploaded == cache_control
+
+    def plan_file(self, path, key, cache=None):
+        """Work out whether path has to be uploaded to key.
+
+        Returns an upload, update or skip Change. Unchanged files whose
+        Cache-Control differs from the rules are updated in place.
+        """
+        size = os.stat(path).st_size
+        content_type, file_encoding = mimetypes.guess_type(key)
+        encoding = self.get_encoding(content_type, file_encoding, size)
+        content_type = content_type or 'text/plain'
+        cache_control = self.cache_control.get(Path(key).suffix.lower())
+
+        etag = self.get_etag(path, key, cache, encoding)
+
+        packed = self.manifest.get(key) if self.manifest is not None \
+            else None
+        if packed is None:
+            action, reason = plan.UPLOAD, 'new'
+        elif packed != pack_etag(etag):
+            action, reason = plan.UPLOAD, 'etags differ'
+        elif self.has_cache_control(self.manifest.bucket_name, key,
+                                    cache_control, cache):
+            action, reason = plan.SKIP, 'etags match'
+        else:
+            action, reason = plan.UPDATE, 'cache control differs'
+
+        return plan.Change(
+            action, key, size, reason, etag,
+            content_type, encoding, cache_control)
+
+    def uploaded(self, bucket_name, change):
+        """Remember the Cache-Control change was uploaded with."""
+        if self.etag_cache is not None:
+            self.etag_cache.put_cache_control(bucket_name, change.key,
+                                              change.cache_control)
+
+    def upload_change(self, bucket_name, path, change, client=None):
+        """Upload path as described by an upload change."""
+        client = client or self.s3.meta.client
+        extra_args = self.get_extra_args(change)
+        if change.content_encoding:
+            data = compression.compress_file(path, change.content_encoding)
+            client.upload_fileobj(
+                io.BytesIO(data),
+                bucket_name,
+                change.key,
+                ExtraArgs=extra_args,
+                Config=self.get_transfer_config(len(data))
+            )
+        else:
+            client.upload_file(
+                path,
+                bucket_name,
+                change.key,
+                ExtraArgs=extra_args,
+                Config=self.get_transfer_config(os.stat(path).st_size)
+            )
+        self.uploaded(bucket_name, change)
+
+    def update_change(self, bucket_name, change, client=None):
+        """Replace the headers of an unchanged key as described by change.
+
+        The object is copied onto itself in parts of the size it was
+        uploaded with, so that its ETag stays the same.
+        """
+        client = client or self.s3.meta.client
+        extra_args = self.get_extra_args(change)
+        extra_args['MetadataDirective'] = 'REPLACE'
+        client.copy(
+            {'Bucket': bucket_name, 'Key': change.key},
+            bucket_name,
+            change.key,
+            ExtraArgs=extra_args,
+            Config=self.get_transfer_config(change.size)
+        )
+        self.uploaded(bucket_name, change)
 
-        etag = self.gen_etag(path)
+    def upload_file(self, bucket, path, key, client=None, cache=None):
+        """Upload path to key unless the bucket already has it.
 
-        if self.manifest.get(key, '') == etag:
+        Returns True if the file was uploaded, False if it was skipped.
+        """
+        change = self.plan_file(path, key, cache)
+        if change.action == plan.SKIP:
             print("Skipping {}, etags match".format(key))
-            return
+            return False
 
-        return bucket.upload_file(
-            path,
-            key,
-            ExtraArgs={
-                'ContentType': content_type
-            },
-            Config=self.transfer_config
-        )
+        if change.action == plan.UPDATE:
+            self.update_change(bucket.name, change, client)
+        else:
+            self.upload_change(bucket.name, path, change, client)
+        return True
+
+    def delete_keys(self, bucket, keys, client=None, workers=1):
+        """Delete keys from bucket with batched DeleteObjects calls.
+
+        Up to workers batches of DELETE_BATCH_SIZE keys are sent at
+        once. Returns the number of keys deleted.
+        """
+        client = client or self.s3.meta.client
+        keys = sorted(keys)
+        batches = [keys[i:i + self.DELETE_BATCH_SIZE]
+                   for i in range(0, len(keys), self.DELETE_BATCH_SIZE)]
+
+        def delete_batch(batch):
+            response = client.delete_objects(
+                Bucket=bucket.name,
+                Delete={
+                    'Objects': [{'Key': key} for key in batch],
+                    'Quiet': True
+                }
+            )
+            errors = response.get('Errors', [])
+            for error in errors:
+                print("Could not delete {}: {}".format(
+                    error['Key'], error['Message']))
+            return len(batch) - len(errors)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return sum(pool.map(delete_batch, batches))
+
+    @staticmethod
+    def walk(root):
+        """Yield every file below root, depth first in directory order."""
+        for p in root.iterdir():
+            if p.is_dir():
+                yield from BucketManager.walk(p)
+            if p.is_file():
+                yield p
+
+    def plan(self, pathname, bucket_name, workers=1, etag_cache=True,
+             listing_workers=1, delete=False, max_delete=None,
+             hash_processes=1, compress=None, cache_control=None,
+             on_change=None, transfer_classes=None):
+        """Work out what syncing pathname to bucket_name would change.
+
+        The bucket is listed while local files are hashed. With
+        workers > 1 files are hashed by a pool of threads. Unless
+        etag_cache is False, local ETags are kept in an ETagCache in
+        the webotron cache directory. With hash_processes > 1 large
+        files are hashed on several cores.
+
+        compress ('gzip' or 'br') uploads compressible files encoded
+        with it. cache_control maps file extensions such as '.html' to
+        the Cache-Control header to upload those files with.
+        transfer_classes replaces TRANSFER_CLASSES, see
+        set_transfer_classes.
+
+        With delete, keys in the bucket that have no local file are
+        deleted, unless there are more than max_delete of them.
+
+        on_change is called from the workers with every upload and skip
+        Change as soon as it is known. Returns the ChangeSet.
+        """
+        if compress:
+            compression.check_encoding(compress)
+        self.encoding = compress
+        self.cache_control = dict(cache_control or {})
+        if transfer_classes:
+            self.set_transfer_classes(transfer_classes)
 
-    
-    def sync(self, pathname, bucket_name):
         bucket = self.s3.Bucket(bucket_name)
-        self.load_manifest(bucket)
+        self.load_manifest(bucket, listing_workers)
 
         root = Path(pathname).expanduser().resolve()
+        cache = ETagCache.for_root(root).load() if etag_cache else None
+        self.etag_cache = cache
+        changeset = plan.ChangeSet(root, bucket_name)
+        local_keys = set()
+
+        def files():
+            for p in self.walk(root):
+                key = p.relative_to(root).as_posix()
+                local_keys.add(key)
+                yield p, key
+
+        def handle_file(item):
+            p, key = item
+            change = self.plan_file(str(p), key, cache)
+            changeset.add(change)
+            if on_change:
+                on_change(change)
+
+        if hash_processes > 1:
+            self.start_hash_pool(hash_processes)
 
-        def handle_directory(target):
-            for p in target.iterdir():
-                if p.is_dir():
-                    handle_directory(p)
-                if p.is_file():
-                    self.upload_file(bucket,
-                            str(p),
-                            str(p.relative_to(root).as_posix()))
+        try:
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    for _ in pool.map(handle_file, files()):
+                        pass
+            else:
+                for item in files():
+                    handle_file(item)
+        finally:
+            self.stop_hash_pool()
+
+        if cache:
+            cache.save()
+        self.etag_cache = None
+
+        if delete:
+            stale = self.manifest.keys() - local_keys
+            if max_delete is not None and len(stale) > max_delete:
+                print("Not deleting {} keys, more than the limit of {}"
+                      .format(len(stale), max_delete))
+            else:
+                for key in stale:
+                    changeset.add(plan.Change(
+                        plan.DELETE, key, reason='removed locally'))
+
+        return changeset
+
+    def apply(self, changeset, pathname=None, bucket_name=None, workers=1,
+              uploads=True, stats=None):
+        """Carry out the changes in changeset.
+
+        Files are read from pathname and written to bucket_name, which
+        default to the ones the changeset was planned for. Nothing is
+        listed or hashed. With uploads False, only deletes are done,
+        for changesets whose uploads already happened during planning.
+        Returns the SyncStats of the run, or adds to stats if given.
+        """
+        root = Path(pathname or changeset.root).expanduser().resolve()
+        bucket = self.s3.Bucket(bucket_name or changeset.bucket_name)
+        client = self.get_client(workers)
+        stats = stats or SyncStats()
+
+        def upload(change):
+            path = root / change.key
+            if path.stat().st_size != change.size:
+                print("Warning: {} changed since it was planned".format(
+                    change.key))
+            self.upload_change(bucket.name, str(path), change, client)
+            stats.add(change.size, True, change.key)
+
+        def update(change):
+            self.update_change(bucket.name, change, client)
+            stats.add_updated(change.size, change.key)
+
+        for change in changeset.skips:
+            stats.add(change.size, False)
+
+        if uploads:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for _ in pool.map(upload, changeset.uploads):
+                    pass
+                for _ in pool.map(update, changeset.updates):
+                    pass
+        else:
+            for change in changeset.uploads:
+                stats.add(change.size, True, change.key)
+            for change in changeset.updates:
+                stats.add_updated(change.size, change.key)
+
+        deletes = [change.key for change in changeset.deletes]
+        if deletes:
+            stats.add_deleted(
+                self.delete_keys(bucket, deletes, client, workers), deletes)
+
+        stats.stop()
+        return stats
+
+    def sync(self, pathname, bucket_name, workers=1, etag_cache=True,
+             listing_workers=1, delete=False, dry_run=False,
+             max_delete=None, hash_processes=1, compress=None,
+             cache_control=None, transfer_classes=None):
+        """Upload the files under pathname that differ from bucket_name.
+
+        Takes the same options as plan. Files are uploaded by the
+        planning workers as soon as they are known to differ, so with
+        workers > 1 output order is not kept. With dry_run nothing is
+        uploaded or deleted. Returns the ChangeSet and the SyncStats
+        of the run.
+        """
+        if transfer_classes:
+            self.set_transfer_classes(transfer_classes)
 
-        handle_directory(root)
\ No newline at end of file
+        root = Path(pathname).expanduser().resolve()
+        client = self.get_client(workers)
+        stats = SyncStats()
+
+        def on_change(change):
+            if change.action == plan.SKIP:
+                print("Skipping {}, etags match".format(change.key))
+            elif dry_run:
+                pass
+            elif change.action == plan.UPDATE:
+                self.update_change(bucket_name, change, client)
+            else:
+                self.upload_change(bucket_name, str(root / change.key),
+                                   change, client)
+
+        changeset = self.plan(root, bucket_name, workers, etag_cache,
+                              listing_workers, delete, max_delete,
+                              hash_processes, compress, cache_control,
+                              on_change)
+        if dry_run:
+            return changeset, None
+
+        self.apply(changeset, workers=workers, uploads=False, stats=stats)
+        return changeset, stats
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""Small on-disk cache for AWS lookups."""
+
+from pathlib import Path
+import json
+import os
+import tempfile
+import time
+
+DEFAULT_TTL = 3600
+
+
+def cache_dir():
+    """Get the directory webotron keeps its caches in."""
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'webotron'
+
+
+class DiskCache:
+    """A JSON value kept on disk for ttl seconds."""
+
+    def __init__(self, name, ttl, directory=None):
+        """Create a DiskCache stored as name.json in directory."""
+        self.path = Path(directory or cache_dir()) / '{}.json'.format(name)
+        self.ttl = ttl
+
+    @classmethod
+    def for_session(cls, session, name, ttl):
+        """Get the cache called name for the profile of session.
+
+        Returns None when ttl is 0, so that callers can skip caching.
+        """
+        if not ttl:
+            return None
+        return cls('{}-{}'.format(name, session.profile_name), ttl)
+
+    def load(self):
+        """Get the cached value, or None if it is missing or too old."""
+        try:
+            with self.path.open() as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get('saved', 0) > self.ttl:
+            return None
+
+        return entry.get('value')
+
+    def save(self, value):
+        """Store value, replacing the file atomically."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(self.path.parent))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'saved': time.time(), 'value': value}, f)
+        os.replace(tmp, str(self.path))
+
+    def clear(self):
+        """Forget the cached value."""
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
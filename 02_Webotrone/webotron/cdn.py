@@ -2,32 +2,167 @@
 
 """Classes for Cloud Front Distributions."""
 
+from urllib.parse import quote
+import heapq
+import time
 import uuid
 
+from cache import DEFAULT_TTL, DiskCache
+import util
+
+
+class DeployTracker:
+    """Wait for many distributions to be deployed at the same time.
+
+    Every distribution is polled on its own schedule, backing off from
+    initial_delay to max_delay seconds, while all polls share one
+    RateLimiter. Callbacks run as soon as their distribution is
+    deployed, without waiting for the others.
+    """
+
+    def __init__(self, client, rate=2.0, initial_delay=15, max_delay=60,
+                 timeout=25 * 60):
+        """Create a DeployTracker polling with client."""
+        self.client = client
+        self.limiter = util.RateLimiter(rate)
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.queue = []
+        self.callbacks = {}
+        self.status = {}
+
+    def add(self, dist, on_deployed=None):
+        """Track dist and call on_deployed(dist) once it is deployed."""
+        self.callbacks[dist['Id']] = (dist, on_deployed)
+        self.status[dist['Id']] = dist.get('Status', 'InProgress')
+        heapq.heappush(self.queue, (time.monotonic() + self.initial_delay,
+                                    self.initial_delay, dist['Id']))
+
+    def poll(self, dist_id):
+        """Get the current status of a distribution."""
+        self.limiter.acquire()
+        result = util.call_with_backoff(self.client.get_distribution,
+                                        Id=dist_id)
+        return result['Distribution']['Status']
+
+    def run(self):
+        """Poll until every distribution is deployed or time runs out.
+
+        Returns a dict from distribution id to its last status.
+        """
+        deadline = time.monotonic() + self.timeout
+        while self.queue:
+            due, delay, dist_id = heapq.heappop(self.queue)
+            if due > deadline:
+                break
+            time.sleep(max(0, due - time.monotonic()))
+
+            self.status[dist_id] = status = self.poll(dist_id)
+            if status == 'Deployed':
+                dist, on_deployed = self.callbacks[dist_id]
+                if on_deployed:
+                    on_deployed(dist)
+                continue
+
+            heapq.heappush(self.queue, (time.monotonic() + delay,
+                                        min(delay * 1.5, self.max_delay),
+                                        dist_id))
+
+        return self.status
+
 
 class DistributionManager:
     """Manage CloudFront distributions."""
 
-    def __init__(self, session):
-        """Create a DistributionManager."""
+    # CloudFront accepts at most 3000 file paths and 15 wildcard paths
+    # in progress per distribution.
+    MAX_INVALIDATION_PATHS = 3000
+    MAX_INVALIDATION_WILDCARDS = 15
+
+    def __init__(self, session, cache_ttl=DEFAULT_TTL):
+        """Create a DistributionManager.
+
+        Distributions are cached on disk for cache_ttl seconds; 0
+        disables the cache.
+        """
         self.session = session
         self.client = self.session.client('cloudfront')
+        self.cache = DiskCache.for_session(session, 'cloudfront', cache_ttl)
+        self.aliases = None
+        self.from_cache = False
+
+    @staticmethod
+    def summarize(dist):
+        """Keep the parts of dist that lookups need."""
+        return {
+            'Id': dist['Id'],
+            'ARN': dist['ARN'],
+            'DomainName': dist['DomainName'],
+            'Status': dist['Status'],
+            'Aliases': dist.get('Aliases', {}).get('Items', [])
+        }
+
+    def load_dists(self, refresh=False):
+        """Load distributions from the cache or CloudFront.
+
+        Builds an index from every alias to its distribution.
+        """
+        dists = None
+        if self.cache and not refresh:
+            dists = self.cache.load()
+        self.from_cache = dists is not None
+
+        if dists is None:
+            paginator = self.client.get_paginator('list_distributions')
+            dists = [self.summarize(dist)
+                     for page in paginator.paginate()
+                     for dist in page['DistributionList'].get('Items', [])]
+            if self.cache:
+                self.cache.save(dists)
+
+        self.aliases = {}
+        for dist in dists:
+            self.add_to_index(dist)
+
+        return dists
+
+    def add_to_index(self, dist):
+        """Index dist by its aliases."""
+        for alias in dist['Aliases']:
+            self.aliases.setdefault(alias.lower(), dist)
+
+    def find_matching_dists(self, domain_names):
+        """Find the dists matching each of domain_names.
+
+        Returns a dict from domain name to distribution, or None where
+        no distribution matches. Cached distributions are refreshed
+        once if any domain is missing, in case its distribution is new.
+        """
+        if self.aliases is None:
+            self.load_dists()
+
+        found = {name: self.aliases.get(name.lower())
+                 for name in domain_names}
+        if self.from_cache and None in found.values():
+            self.load_dists(refresh=True)
+            found = {name: self.aliases.get(name.lower())
+                     for name in domain_names}
+
+        return found
 
     def find_matching_dist(self, domain_name):
         """Find a dist matching domain_name."""
-        paginator = self.client.get_paginator('list_distributions')
-        for page in paginator.paginate():
-            print(page)
-            for dist in page['DistributionList'].get('Items', []):
-                for alias in dist['Aliases']['Items']:
-                    if alias == domain_name:
-                        return dist
+        return self.find_matching_dists([domain_name])[domain_name]
 
-        return None
+    def create_dist(self, domain_name, cert, bucket_name=None):
+        """Create a dist for domain_name using cert.
 
-    def create_dist(self, domain_name, cert):
-        """Create a dist for domain_name using cert."""
-        origin_id = 'S3-' + domain_name
+        The dist serves bucket_name, by default the bucket named after
+        domain_name.
+        """
+        bucket_name = bucket_name or domain_name
+        origin_id = 'S3-' + bucket_name
 
         result = self.client.create_distribution(
             DistributionConfig={
@@ -44,7 +179,7 @@ class DistributionManager:
                     'Items': [{
                         'Id': origin_id,
                         'DomainName':
-                        '{}.s3.amazonaws.com'.format(domain_name),
+                        '{}.s3.amazonaws.com'.format(bucket_name),
                         'S3OriginConfig': {
                             'OriginAccessIdentity': ''
                         }
@@ -74,7 +209,18 @@ class DistributionManager:
             }
         )
 
-        return result['Distribution']
+        dist = result['Distribution']
+        if self.aliases is not None:
+            self.add_to_index(self.summarize(
+                dict(dist, Aliases=dist['DistributionConfig']['Aliases'])))
+        if self.cache:
+            self.cache.clear()
+
+        return dist
+
+    def track_deploys(self, **kwargs):
+        """Get a DeployTracker for distributions of this account."""
+        return DeployTracker(self.client, **kwargs)
 
     def await_deploy(self, dist):
         """Wait for dist to be deployed."""
@@ -82,4 +228,60 @@ class DistributionManager:
         waiter.wait(Id=dist['Id'], WaiterConfig={
             'Delay': 30,
             'MaxAttempts': 50
-        })
\ No newline at end of file
+        })
+
+    @classmethod
+    def invalidation_paths(cls, keys):
+        """Get the paths to invalidate for the changed keys.
+
+        When there are too many keys, they are collapsed into wildcard
+        prefixes, as deep as the limits allow.
+        """
+        paths = {'/' + quote(key, safe='/~') for key in keys}
+        if '/index.html' in paths:
+            paths.add('/')
+
+        if len(paths) <= cls.MAX_INVALIDATION_PATHS:
+            return sorted(paths)
+
+        split_keys = [key.split('/') for key in keys]
+        max_depth = max(len(parts) for parts in split_keys) - 1
+        for depth in range(max_depth, 0, -1):
+            wildcards = set()
+            files = set()
+            for parts in split_keys:
+                if len(parts) > depth:
+                    wildcards.add('/' + quote('/'.join(parts[:depth]),
+                                              safe='/~') + '/*')
+                else:
+                    files.add('/' + quote('/'.join(parts), safe='/~'))
+
+            if len(wildcards) <= cls.MAX_INVALIDATION_WILDCARDS and \
+                    len(wildcards) + len(files) <= \
+                    cls.MAX_INVALIDATION_PATHS:
+                if '/index.html' in files:
+                    files.add('/')
+                return sorted(wildcards | files)
+
+        return ['/*']
+
+    def invalidate(self, dist, keys, wait=False):
+        """Invalidate the changed keys in dist with one invalidation."""
+        paths = self.invalidation_paths(keys)
+        result = self.client.create_invalidation(
+            DistributionId=dist['Id'],
+            InvalidationBatch={
+                'Paths': {
+                    'Quantity': len(paths),
+                    'Items': paths
+                },
+                'CallerReference': str(uuid.uuid4())
+            }
+        )
+        invalidation = result['Invalidation']
+
+        if wait:
+            waiter = self.client.get_waiter('invalidation_completed')
+            waiter.wait(DistributionId=dist['Id'], Id=invalidation['Id'])
+
+        return invalidation
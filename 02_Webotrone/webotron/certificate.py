@@ -2,14 +2,33 @@
 
 """Classes for ACM Certificates."""
 
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.config import Config
+
+from cache import DEFAULT_TTL, DiskCache
+
 
 class CertificateManager:
     """Manage an ACM Certificate."""
 
-    def __init__(self, session):
-        """Create a CertificateManager."""
+    WORKERS = 8
+
+    def __init__(self, session, cache_ttl=DEFAULT_TTL):
+        """Create a CertificateManager.
+
+        Certificates and their names are cached on disk for cache_ttl
+        seconds; 0 disables the cache.
+        """
         self.session = session
-        self.client = self.session.client('acm', region_name='us-east-1')
+        self.client = self.session.client(
+            'acm', region_name='us-east-1',
+            config=Config(retries={'max_attempts': 10}))
+        self.cache = DiskCache.for_session(session, 'acm', cache_ttl)
+        self.certs = None
+        self.from_cache = False
+        self.names = {}
+        self.wildcards = {}
 
     def cert_matches(self, cert_arn, domain_name):
         """Return True if cert matches domain_name."""
@@ -24,12 +43,94 @@ class CertificateManager:
                 return True
         return False
 
-    def find_matching_cert(self, domain_name):
-        """Find a certificate matching domain_name."""
+    def describe_cert(self, cert):
+        """Get a summary of cert with its subject alternative names."""
+        cert_details = self.client.describe_certificate(
+                CertificateArn=cert['CertificateArn']
+        )
+        return {
+            'CertificateArn': cert['CertificateArn'],
+            'DomainName': cert['DomainName'],
+            'SubjectAlternativeNames':
+                cert_details['Certificate'].get('SubjectAlternativeNames', [])
+        }
+
+    def fetch_certs(self):
+        """Get all issued certificates, describing them concurrently."""
         paginator = self.client.get_paginator('list_certificates')
-        for page in paginator.paginate(CertificateStatuses=['ISSUED']):
-            for cert in page['CertificateSummaryList']:
-                if self.cert_matches(cert['CertificateArn'], domain_name):
-                    return cert
+        summaries = [cert
+                     for page in paginator.paginate(
+                         CertificateStatuses=['ISSUED'])
+                     for cert in page['CertificateSummaryList']]
+
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as pool:
+            return list(pool.map(self.describe_cert, summaries))
+
+    def load_certs(self, refresh=False):
+        """Load certificates from the cache or ACM and index their names.
+
+        Exact names and wildcard suffixes ('*.example.com' is kept as
+        'example.com') are indexed to the certificates covering them.
+        """
+        certs = None
+        if self.cache and not refresh:
+            certs = self.cache.load()
+        self.from_cache = certs is not None
 
-        return None
\ No newline at end of file
+        if certs is None:
+            certs = self.fetch_certs()
+            if self.cache:
+                self.cache.save(certs)
+
+        self.certs = certs
+        self.names = {}
+        self.wildcards = {}
+        for cert in certs:
+            for name in cert['SubjectAlternativeNames']:
+                name = name.lower().rstrip('.')
+                if name.startswith('*.'):
+                    self.wildcards.setdefault(name[2:], []).append(cert)
+                else:
+                    self.names.setdefault(name, []).append(cert)
+
+        return certs
+
+    def lookup(self, domain_name):
+        """Find a loaded certificate covering domain_name.
+
+        A wildcard only covers a single label, as in TLS.
+        """
+        domain_name = domain_name.lower().rstrip('.')
+        certs = self.names.get(domain_name)
+        if not certs and '.' in domain_name:
+            certs = self.wildcards.get(domain_name.split('.', 1)[1])
+
+        if not certs:
+            return None
+
+        cert = certs[0]
+        return {
+            'CertificateArn': cert['CertificateArn'],
+            'DomainName': cert['DomainName']
+        }
+
+    def find_matching_certs(self, domain_names):
+        """Find certificates matching each of domain_names.
+
+        Returns a dict from domain name to certificate, or None where
+        no certificate matches. Cached certificates are refreshed once
+        if any domain is not covered, in case its certificate is new.
+        """
+        if self.certs is None:
+            self.load_certs()
+
+        found = {name: self.lookup(name) for name in domain_names}
+        if self.from_cache and None in found.values():
+            self.load_certs(refresh=True)
+            found = {name: self.lookup(name) for name in domain_names}
+
+        return found
+
+    def find_matching_cert(self, domain_name):
+        """Find a certificate matching domain_name."""
+        return self.find_matching_certs([domain_name])[domain_name]
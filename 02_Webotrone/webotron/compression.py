@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""Compression of text assets before upload."""
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = ('gzip', 'br')
+
+MAX_SIZE = 32 * 1024**2
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/xml',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/vnd.microsoft.icon',
+}
+
+
+def is_compressible(content_type, file_encoding=None, size=0):
+    """Return True if a file of content_type is worth compressing.
+
+    Files of unknown type, files that are already encoded (as told by
+    mimetypes.guess_type) and files over MAX_SIZE are not compressed.
+    Compressed files are held in memory, so MAX_SIZE bounds that.
+    """
+    if content_type is None or file_encoding is not None or \
+            size > MAX_SIZE:
+        return False
+    return content_type.startswith('text/') or \
+        content_type in COMPRESSIBLE_TYPES
+
+
+def check_encoding(encoding):
+    """Raise ValueError if encoding can not be used here."""
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown encoding {}".format(encoding))
+    if encoding == 'br' and brotli is None:
+        raise ValueError("The brotli package is needed for br encoding")
+
+
+def compress(data, encoding):
+    """Compress data with encoding.
+
+    gzip output has a zero mtime, so the same input always compresses
+    to the same bytes and the same ETag.
+    """
+    if encoding == 'br':
+        return brotli.compress(data)
+
+    return gzip.compress(data, mtime=0)
+
+
+def compress_file(path, encoding):
+    """Compress the content of the file at path."""
+    with open(path, 'rb') as f:
+        return compress(f.read(), encoding)
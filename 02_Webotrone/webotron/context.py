@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""Lazily built AWS session and managers for one webotron run."""
+
+import cache
+
+
+class WebotronContext:
+    """Session and managers of one webotron run.
+
+    Nothing is created until a command first asks for it, so commands
+    only pay for the AWS clients they use. boto3 and the manager
+    modules are imported on first use as well, which keeps --help and
+    argument errors fast.
+    """
+
+    def __init__(self, profile=None, cache_ttl=cache.DEFAULT_TTL):
+        """Create a WebotronContext for profile."""
+        self.profile = profile
+        self.cache_ttl = cache_ttl
+        self._session = None
+        self._bucket_manager = None
+        self._domain_manager = None
+        self._cert_manager = None
+        self._dist_manager = None
+
+    @property
+    def session(self):
+        """The boto3 session."""
+        if self._session is None:
+            import boto3
+
+            session_cfg = {}
+            if self.profile:
+                session_cfg['profile_name'] = self.profile
+            self._session = boto3.Session(**session_cfg)
+        return self._session
+
+    @property
+    def bucket_manager(self):
+        """The BucketManager."""
+        if self._bucket_manager is None:
+            self._bucket_manager = self.new_bucket_manager()
+        return self._bucket_manager
+
+    def new_bucket_manager(self):
+        """Create a BucketManager of its own, for one sync."""
+        from bucket import BucketManager
+        return BucketManager(self.session, self.cache_ttl)
+
+    @property
+    def domain_manager(self):
+        """The DomainManager."""
+        if self._domain_manager is None:
+            from domain import DomainManager
+            self._domain_manager = DomainManager(self.session,
+                                                 self.cache_ttl)
+        return self._domain_manager
+
+    @property
+    def cert_manager(self):
+        """The CertificateManager."""
+        if self._cert_manager is None:
+            from certificate import CertificateManager
+            self._cert_manager = CertificateManager(self.session,
+                                                    self.cache_ttl)
+        return self._cert_manager
+
+    @property
+    def dist_manager(self):
+        """The DistributionManager."""
+        if self._dist_manager is None:
+            from cdn import DistributionManager
+            self._dist_manager = DistributionManager(self.session,
+                                                     self.cache_ttl)
+        return self._dist_manager
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+"""Deploy many sites at once from a site definition file."""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+import json
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+import util
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+SITE_DEFAULTS = {
+    'bucket': None,
+    'path': None,
+    'cdn': False,
+    'dns': True,
+    'delete': False,
+    'compress': None,
+    'cache_control': {},
+}
+
+
+def load_sites(path):
+    """Read site definitions from a YAML or JSON file.
+
+    The file holds a list of sites, or a dict with the list under
+    'sites'. Every site needs a domain; the bucket defaults to the
+    domain, and may only differ from it when the site is served by
+    CloudFront or has no DNS record. Raises ValueError if the file is
+    not valid.
+    """
+    path = Path(path)
+    with path.open() as f:
+        if path.suffix.lower() in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ValueError(
+                    "The PyYAML package is needed to read {}".format(path))
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+
+    if isinstance(data, dict):
+        data = data.get('sites')
+    if not isinstance(data, list):
+        raise ValueError("{} has no list of sites".format(path))
+
+    sites = []
+    for site in data:
+        if not isinstance(site, dict) or not site.get('domain'):
+            raise ValueError("Every site needs a domain, got {}".format(site))
+        unknown = set(site) - set(SITE_DEFAULTS) - {'domain'}
+        if unknown:
+            raise ValueError("Unknown keys {} for site {}".format(
+                ', '.join(sorted(unknown)), site['domain']))
+
+        site = dict(SITE_DEFAULTS, **site)
+        site['bucket'] = site['bucket'] or site['domain']
+        if site['dns'] and not site['cdn'] and \
+                site['bucket'] != site['domain']:
+            raise ValueError(
+                "S3 only serves {} from a bucket of the same name; set "
+                "cdn: true or dns: false to use bucket {}".format(
+                    site['domain'], site['bucket']))
+        if site['path'] and not Path(site['path']).is_dir():
+            raise ValueError("{} of site {} is not a directory".format(
+                site['path'], site['domain']))
+        sites.append(site)
+
+    domains = [site['domain'] for site in sites]
+    if len(set(domains)) != len(domains):
+        raise ValueError("A domain is defined more than once")
+
+    return sites
+
+
+class Task:
+    """One step of a deploy, run once the tasks it needs are done."""
+
+    def __init__(self, name, service, run, needs=()):
+        """Create a Task calling run with the results of needs."""
+        self.name = name
+        self.service = service
+        self.run = run
+        self.needs = tuple(needs)
+        self.status = PENDING
+        self.result = None
+        self.error = None
+
+
+class TaskGraph:
+    """Tasks and the tasks they need, run in parallel.
+
+    A task starts as soon as every task it needs is done, while at most
+    limits[service] tasks of the same service run at the same time.
+    Tasks needing a task that failed are skipped.
+    """
+
+    DEFAULT_LIMIT = 1
+
+    def __init__(self, limits=None):
+        """Create an empty TaskGraph."""
+        self.limits = dict(limits or {})
+        self.tasks = {}
+
+    def add(self, name, service, run, needs=()):
+        """Add a task; the tasks it needs must have been added first."""
+        if name in self.tasks:
+            raise ValueError("Task {} is already defined".format(name))
+        for need in needs:
+            if need not in self.tasks:
+                raise ValueError("Task {} needs unknown task {}".format(
+                    name, need))
+
+        task = Task(name, service, run, needs)
+        self.tasks[name] = task
+        return task
+
+    def limit(self, service):
+        """Get how many tasks of service may run at the same time."""
+        return self.limits.get(service, self.DEFAULT_LIMIT)
+
+    def run(self, on_done=None):
+        """Run every task, calling on_done(task) as each one finishes.
+
+        Returns the tasks by name.
+        """
+        pending = list(self.tasks.values())
+        running = {}
+        active = {}
+        workers = sum(self.limit(service)
+                      for service in {t.service for t in pending}) or 1
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for task in list(pending):
+                    needs = [self.tasks[need] for need in task.needs]
+                    if any(n.status in (FAILED, SKIPPED) for n in needs):
+                        task.status = SKIPPED
+                    elif any(n.status != DONE for n in needs) or \
+                            active.get(task.service, 0) >= \
+                            self.limit(task.service):
+                        continue
+                    else:
+                        active[task.service] = \
+                            active.get(task.service, 0) + 1
+                        running[pool.submit(
+                            task.run, *[n.result for n in needs])] = task
+
+                    pending.remove(task)
+                    if task.status == SKIPPED and on_done:
+                        on_done(task)
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    active[task.service] -= 1
+                    try:
+                        task.result = future.result()
+                        task.status = DONE
+                    except Exception as e:
+                        task.error = e
+                        task.status = FAILED
+                    if on_done:
+                        on_done(task)
+
+        return self.tasks
+
+
+class Deployer:
+    """Deploy sites with the managers of a WebotronContext.
+
+    Hosted zones, certificates and distributions are looked up once for
+    all sites, and every site's steps only wait for the steps they
+    depend on:
+
+        bucket -> policy, website -> sync
+        certs -> cert -> distribution
+        zones, website or distribution -> dns
+    """
+
+    LIMITS = {
+        's3': 8,
+        'sync': 2,
+        'acm': 4,
+        'cloudfront': 2,
+        'route53': 2,
+    }
+
+    def __init__(self, obj, limits=None, workers=1):
+        """Create a Deployer.
+
+        limits overrides how many steps per service run at once. Each
+        sync uploads with workers threads.
+        """
+        self.obj = obj
+        self.limits = dict(self.LIMITS, **(limits or {}))
+        self.workers = workers
+        self.sync_managers = {}
+
+    def add_managers(self, sites):
+        """Create the managers the steps of sites use.
+
+        boto3 sessions are not thread safe, so every client is created
+        here rather than by the steps. A BucketManager keeps the state
+        of one sync, so each sync gets a BucketManager of its own.
+        """
+        self.obj.bucket_manager
+        if any(site['cdn'] for site in sites):
+            self.obj.cert_manager
+            self.obj.dist_manager
+        if any(site['dns'] for site in sites):
+            self.obj.domain_manager
+
+        for site in sites:
+            if site['path']:
+                manager = self.obj.new_bucket_manager()
+                manager.get_client(self.workers)
+                self.sync_managers[site['domain']] = manager
+
+    def add_indexes(self, graph, sites):
+        """Add the lookups shared by all sites."""
+        cdn_domains = [site['domain'] for site in sites if site['cdn']]
+        dns_domains = [site['domain'] for site in sites if site['dns']]
+
+        if cdn_domains:
+            graph.add('certs', 'acm', lambda:
+                      self.obj.cert_manager.find_matching_certs(cdn_domains))
+            graph.add('dists', 'cloudfront', lambda:
+                      self.obj.dist_manager.find_matching_dists(cdn_domains))
+        if dns_domains:
+            graph.add('zones', 'route53', lambda: {
+                domain: self.obj.domain_manager.find_hosted_zone(domain)
+                for domain in dns_domains})
+
+    def add_site(self, graph, site):
+        """Add the steps deploying one site."""
+        domain = site['domain']
+        manager = self.obj.bucket_manager
+
+        def name(step):
+            return '{}:{}'.format(step, domain)
+
+        graph.add(name('bucket'), 's3',
+                  lambda: manager.init_bucket(site['bucket']))
+        graph.add(name('policy'), 's3', manager.set_policy,
+                  [name('bucket')])
+        graph.add(name('website'), 's3', manager.configure_website,
+                  [name('bucket')])
+
+        if site['path']:
+            graph.add(name('sync'), 'sync', lambda policy, website:
+                      self.sync_managers[domain].sync(site['path'], site['bucket'],
+                                   workers=self.workers,
+                                   delete=site['delete'],
+                                   compress=site['compress'],
+                                   cache_control=site['cache_control'])[1],
+                      [name('policy'), name('website')])
+
+        if site['cdn']:
+            graph.add(name('cert'), 'acm', lambda certs:
+                      self.found(certs, domain, 'certificate'), ['certs'])
+            graph.add(name('distribution'), 'cloudfront',
+                      lambda dists, cert, bucket:
+                      dists[domain] or
+                      self.obj.dist_manager.create_dist(
+                          domain, cert, site['bucket']),
+                      ['dists', name('cert'), name('bucket')])
+
+        if site['dns'] and site['cdn']:
+            graph.add(name('dns'), 'route53', lambda zones, dist:
+                      self.obj.domain_manager.create_cf_domain_record(
+                          self.found(zones, domain, 'hosted zone'),
+                          domain, dist['DomainName'])['ChangeInfo'],
+                      ['zones', name('distribution')])
+        elif site['dns']:
+            graph.add(name('dns'), 'route53', lambda zones, bucket, website:
+                      self.obj.domain_manager.create_s3_domain_record(
+                          self.found(zones, domain, 'hosted zone'),
+                          domain, util.get_endpoint(
+                              manager.get_region_name(bucket))
+                      )['ChangeInfo'],
+                      ['zones', name('bucket'), name('website')])
+
+    @staticmethod
+    def found(results, domain, what):
+        """Get the result of a lookup for domain, or raise ValueError."""
+        if not results.get(domain):
+            raise ValueError("No {} found for {}".format(what, domain))
+        return results[domain]
+
+    def plan(self, sites):
+        """Get the TaskGraph deploying sites."""
+        graph = TaskGraph(self.limits)
+        self.add_managers(sites)
+        self.add_indexes(graph, sites)
+        for site in sites:
+            self.add_site(graph, site)
+        return graph
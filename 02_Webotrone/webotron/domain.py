@@ -2,76 +2,223 @@
 
 """Classes for Route53 domains."""
 
+from concurrent.futures import ThreadPoolExecutor
 import uuid
 
+from cache import DEFAULT_TTL, DiskCache
+import util
+
+
+def domain_labels(domain_name):
+    """Get the labels of domain_name, top level domain first."""
+    return domain_name.lower().rstrip('.').split('.')[::-1]
+
+
+class ZoneIndex:
+    """Hosted zones in a trie of their labels, top level domain first.
+
+    Public and private zones are kept apart. A lookup walks the labels
+    of a domain once and returns the zone with the longest matching
+    name, so sub.example.com wins over example.com and badexample.com
+    never matches example.com.
+    """
+
+    ZONE = None
+
+    def __init__(self, zones=()):
+        """Create a ZoneIndex of zones."""
+        self.tries = {False: {}, True: {}}
+        for zone in zones:
+            self.add(zone)
+
+    def add(self, zone):
+        """Add a zone, keeping the first one added for the same name."""
+        private = zone.get('Config', {}).get('PrivateZone', False)
+        node = self.tries[private]
+        for label in domain_labels(zone['Name']):
+            node = node.setdefault(label, {})
+        node.setdefault(self.ZONE, zone)
+
+    def lookup(self, domain_name, private=False):
+        """Get the zone with the longest name that domain_name is in."""
+        node = self.tries[private]
+        zone = None
+        for label in domain_labels(domain_name):
+            node = node.get(label)
+            if node is None:
+                break
+            zone = node.get(self.ZONE, zone)
+        return zone
+
+
 class DomainManager:
     """Manage a Route53 domain."""
 
-    def __init__(self, session):
+    CLOUDFRONT_ZONE_ID = 'Z2FDTNDATAQYW2'
+
+    # One ChangeBatch may hold 1000 record changes, an UPSERT counting
+    # twice, and 32000 characters of record names and values.
+    MAX_BATCH_RECORDS = 1000
+    MAX_BATCH_CHARS = 32000
+
+    def __init__(self, session, cache_ttl=DEFAULT_TTL):
+        """Create a DomainManager.
+
+        Hosted zones are cached on disk for cache_ttl seconds; 0
+        disables the cache.
+        """
         self.session = session
         self.client = self.session.client('route53')
+        self.cache = DiskCache.for_session(session, 'route53', cache_ttl)
+        self.zones = None
+        self.index = None
+        self.from_cache = False
+
+    def load_zones(self, refresh=False):
+        """Load hosted zones from the cache or Route53 and index them."""
+        zones = None
+        if self.cache and not refresh:
+            zones = self.cache.load()
+        self.from_cache = zones is not None
+
+        if zones is None:
+            paginator = self.client.get_paginator('list_hosted_zones')
+            zones = [zone
+                     for page in paginator.paginate()
+                     for zone in page['HostedZones']]
+            if self.cache:
+                self.cache.save(zones)
+
+        self.zones = zones
+        self.index = ZoneIndex(zones)
+        return zones
 
+    def find_hosted_zone(self, domain_name, private=False):
+        """Find the most specific hosted zone domain_name belongs to.
 
-    def find_hosted_zone(self, domain_name):
-        paginator = self.client.get_paginator('list_hosted_zones')
-        for page in paginator.paginate():
-            for zone in page['HostedZones']:
-                if domain_name.endswith(zone['Name'][:-1]):
-                    return zone
+        Cached zones are refreshed once when nothing matches, in case
+        the zone is new.
+        """
+        if self.index is None:
+            self.load_zones()
 
-        return None
+        zone = self.index.lookup(domain_name, private)
+        if zone is None and self.from_cache:
+            self.load_zones(refresh=True)
+            zone = self.index.lookup(domain_name, private)
+
+        return zone
 
     def create_hosted_zone(self, domain_name):
         """Create a hosted zone to match domain_name."""
         zone_name = '.'.join(domain_name.split('.')[-2:]) + '.'
-        return self.client.create_hosted_zone(
+        zone = self.client.create_hosted_zone(
             Name=zone_name,
             CallerReference=str(uuid.uuid4())
-        )
+        )['HostedZone']
 
+        if self.index is not None:
+            self.zones.append(zone)
+            self.index.add(zone)
+        if self.cache:
+            self.cache.clear()
 
-    def create_s3_domain_record(self, zone, domain_name, endpoint):
-        """Create a domain record in zone for domain_name."""
-        return self.client.change_resource_record_sets(
-            HostedZoneId=zone['Id'],
-            ChangeBatch={
-                'Comment': 'Created by webotron',
-                'Changes': [{
-                        'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'HostedZoneId': endpoint.zone,
-                                'DNSName': endpoint.host,
-                                'EvaluateTargetHealth': False
-                            }
-                        }
-                    }
-                ]
+        return zone
+
+
+    @staticmethod
+    def alias_change(domain_name, target_zone_id, target_dns_name):
+        """Get an UPSERT of an A alias record for domain_name."""
+        return {
+            'Action': 'UPSERT',
+            'ResourceRecordSet': {
+                'Name': domain_name,
+                'Type': 'A',
+                'AliasTarget': {
+                    'HostedZoneId': target_zone_id,
+                    'DNSName': target_dns_name,
+                    'EvaluateTargetHealth': False
+                }
             }
-        )
+        }
 
+    def s3_alias_change(self, domain_name, endpoint):
+        """Get the change pointing domain_name to an S3 website endpoint."""
+        return self.alias_change(domain_name, endpoint.zone, endpoint.host)
 
-    def create_cf_domain_record(self, zone, domain_name, cf_domain):
-        """Create a domain record in zone for domain_name."""
-        return self.client.change_resource_record_sets(
+    def cf_alias_change(self, domain_name, cf_domain):
+        """Get the change pointing domain_name to a CloudFront domain."""
+        return self.alias_change(domain_name, self.CLOUDFRONT_ZONE_ID,
+                                 cf_domain)
+
+    def change_records(self, zone, changes):
+        """Apply changes to the records of zone in one ChangeBatch."""
+        return util.call_with_backoff(
+            self.client.change_resource_record_sets,
             HostedZoneId=zone['Id'],
             ChangeBatch={
                 'Comment': 'Created by webotron',
-                'Changes': [{
-                        'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'HostedZoneId': 'Z2FDTNDATAQYW2',
-                                'DNSName': cf_domain,
-                                'EvaluateTargetHealth': False
-                            }
-                        }
-                    }
-                ]
+                'Changes': changes
             }
         )
 
+    @classmethod
+    def batch_changes(cls, changes):
+        """Split changes into batches within the ChangeBatch limits.
+
+        An UPSERT counts as two record changes, and the record names and
+        values of a batch may not add up to more than MAX_BATCH_CHARS.
+        """
+        batch, records, chars = [], 0, 0
+        for change in changes:
+            record = change['ResourceRecordSet']
+            weight = 2 if change['Action'] == 'UPSERT' else 1
+            size = len(record['Name']) + len(
+                record.get('AliasTarget', {}).get('DNSName', ''))
+            if batch and (records + weight > cls.MAX_BATCH_RECORDS or
+                          chars + size > cls.MAX_BATCH_CHARS):
+                yield batch
+                batch, records, chars = [], 0, 0
+            batch.append(change)
+            records += weight
+            chars += size
+
+        if batch:
+            yield batch
+
+    def change_records_batched(self, changes_by_zone, workers=4):
+        """Apply changes to several zones in as few requests as possible.
+
+        changes_by_zone is a list of (zone, changes) pairs. Batches are
+        sent by up to workers threads, backing off when Route53
+        throttles. Returns the ChangeInfo of every batch.
+        """
+        requests = [(zone, batch)
+                    for zone, changes in changes_by_zone
+                    for batch in self.batch_changes(changes)]
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda r: self.change_records(*r), requests)
+            return [result['ChangeInfo'] for result in results]
+
+    def await_changes(self, change_infos, workers=4):
+        """Wait until all changes are in sync, polling them concurrently."""
+        waiter = self.client.get_waiter('resource_record_sets_changed')
+        change_ids = {info['Id'] for info in change_infos
+                      if info['Status'] != 'INSYNC'}
+
+        def wait(change_id):
+            waiter.wait(Id=change_id, WaiterConfig={'Delay': 10})
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(wait, change_ids))
+
+    def create_s3_domain_record(self, zone, domain_name, endpoint):
+        """Create a domain record in zone for domain_name."""
+        return self.change_records(
+            zone, [self.s3_alias_change(domain_name, endpoint)])
+
+    def create_cf_domain_record(self, zone, domain_name, cf_domain):
+        """Create a domain record in zone for domain_name."""
+        return self.change_records(
+            zone, [self.cf_alias_change(domain_name, cf_domain)])
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of local file ETags."""
+
+from hashlib import sha256
+import sqlite3
+import threading
+import time
+
+import cache
+
+
+class ETagCache:
+    """Remember the ETag of local files between syncs.
+
+    Entries are keyed by the file's key in the bucket and are valid
+    only while its size, mtime, inode, the chunk size used for hashing
+    and the content encoding it is uploaded with stay the same. Entries
+    for files that were not seen during a run are pruned on save.
+
+    The Cache-Control each key was last uploaded with is kept as well,
+    per bucket, so that changed rules reach objects whose content is
+    unchanged.
+
+    A cache file that cannot be read or written only costs speed: the
+    sync goes on without it after a warning.
+    """
+
+    # A file written again within the mtime resolution of the
+    # filesystem keeps its mtime, so very fresh files are not cached.
+    MIN_AGE_NS = 2 * 10**9
+
+    SCHEMA_VERSION = 3
+
+    def __init__(self, path):
+        """Create an ETagCache stored in the sqlite file at path."""
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.cache_controls = {}
+        self.seen = set()
+        self.dirty = False
+        self.started_ns = time.time_ns()
+
+    @classmethod
+    def for_root(cls, root):
+        """Get the cache of the site directory root.
+
+        It is kept in the webotron cache directory, named after the
+        resolved path of root.
+        """
+        name = sha256(str(root.resolve()).encode()).hexdigest()
+        return cls(cache.cache_dir() / 'etags' / '{}.sqlite'.format(name))
+
+    def connect(self):
+        """Open the sqlite file, creating the table if needed."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path))
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            conn.execute("DROP TABLE IF EXISTS etags")
+            conn.execute("DROP TABLE IF EXISTS cache_controls")
+            conn.execute("PRAGMA user_version = {}".format(
+                self.SCHEMA_VERSION))
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS etags (
+                key TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                inode INTEGER,
+                chunk_size INTEGER,
+                encoding TEXT,
+                etag TEXT
+            );
+            CREATE TABLE IF NOT EXISTS cache_controls (
+                bucket TEXT,
+                key TEXT,
+                cache_control TEXT,
+                PRIMARY KEY (bucket, key)
+            );
+            """)
+        return conn
+
+    def load(self):
+        """Read all entries into memory."""
+        try:
+            conn = self.connect()
+            try:
+                for row in conn.execute("SELECT * FROM etags"):
+                    self.entries[row[0]] = row[1:]
+                for row in conn.execute("SELECT * FROM cache_controls"):
+                    self.cache_controls[row[:2]] = row[2]
+            finally:
+                conn.close()
+        except (OSError, sqlite3.Error) as e:
+            print("Warning: not using ETag cache {}: {}".format(
+                self.path, e))
+            self.entries = {}
+            self.cache_controls = {}
+        return self
+
+    def get(self, key, st, chunk_size, encoding=None):
+        """Get the cached ETag of key if stat result st still matches."""
+        with self.lock:
+            self.seen.add(key)
+            entry = self.entries.get(key)
+
+        if entry and entry[:5] == (st.st_size, st.st_mtime_ns, st.st_ino,
+                                   chunk_size, encoding):
+            return entry[5]
+
+        return None
+
+    def put(self, key, st, chunk_size, etag, encoding=None):
+        """Remember the ETag of key for stat result st."""
+        if etag is None or \
+                st.st_mtime_ns > self.started_ns - self.MIN_AGE_NS:
+            return
+
+        with self.lock:
+            self.seen.add(key)
+            self.entries[key] = (st.st_size, st.st_mtime_ns, st.st_ino,
+                                 chunk_size, encoding, etag)
+            self.dirty = True
+
+    def get_cache_control(self, bucket_name, key):
+        """Get the Cache-Control key was last uploaded with, if known."""
+        with self.lock:
+            return self.cache_controls.get((bucket_name, key))
+
+    def put_cache_control(self, bucket_name, key, cache_control):
+        """Remember the Cache-Control key was uploaded with."""
+        with self.lock:
+            if self.cache_controls.get((bucket_name, key), ()) != \
+                    cache_control:
+                self.cache_controls[bucket_name, key] = cache_control
+                self.dirty = True
+
+    def save(self):
+        """Write entries seen during this run and prune the rest."""
+        stale = self.entries.keys() - self.seen
+        stale_cache_controls = [bucket_key for bucket_key in
+                                self.cache_controls
+                                if bucket_key[1] not in self.seen]
+        if not self.dirty and not stale and not stale_cache_controls:
+            return
+
+        for key in stale:
+            del self.entries[key]
+        for bucket_key in stale_cache_controls:
+            del self.cache_controls[bucket_key]
+
+        try:
+            conn = self.connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM etags")
+                    conn.executemany(
+                        "INSERT INTO etags VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        ((key,) + entry
+                         for key, entry in self.entries.items()))
+                    conn.execute("DELETE FROM cache_controls")
+                    conn.executemany(
+                        "INSERT INTO cache_controls VALUES (?, ?, ?)",
+                        (bucket_key + (cache_control,) for bucket_key,
+                         cache_control in self.cache_controls.items()))
+            finally:
+                conn.close()
+        except (OSError, sqlite3.Error) as e:
+            print("Warning: could not save ETag cache {}: {}".format(
+                self.path, e))
+            return
+
+        self.dirty = False
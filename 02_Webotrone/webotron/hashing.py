@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""S3 compatible ETag computation for local files."""
+
+from hashlib import md5
+import os
+import threading
+
+from s3transfer.utils import ChunksizeAdjuster
+
+# Files are read in slices of READ_SIZE bytes, so hashing a part does
+# not need a buffer the size of the part.
+READ_SIZE = 1024 * 1024
+
+_local = threading.local()
+
+
+def get_buffer():
+    """Get a reusable read buffer of READ_SIZE bytes for this thread."""
+    buf = getattr(_local, 'buffer', None)
+    if buf is None:
+        buf = _local.buffer = bytearray(READ_SIZE)
+    return buf
+
+
+def read_slices(f, size=None):
+    """Yield views of the next size bytes of f, or of all of it.
+
+    Slices are read into one reused buffer, so each view is only valid
+    until the next one is produced.
+    """
+    view = memoryview(get_buffer())
+    while size is None or size > 0:
+        read = f.readinto(view if size is None else view[:size])
+        if not read:
+            break
+        if size is not None:
+            size -= read
+        yield view[:read]
+
+
+def file_md5(path):
+    """Get the md5 hash of the whole file at path."""
+    hash = md5()
+    with open(path, 'rb', buffering=0) as f:
+        for data in read_slices(f):
+            hash.update(data)
+    return hash
+
+
+def part_digests(path, chunk_size, first=0, count=None):
+    """Get md5 digests of count parts of path, starting at part first."""
+    digests = []
+    with open(path, 'rb', buffering=0) as f:
+        f.seek(first * chunk_size)
+        while count is None or len(digests) < count:
+            hash = md5()
+            size = 0
+            for data in read_slices(f, chunk_size):
+                hash.update(data)
+                size += len(data)
+            if not size:
+                break
+            digests.append(hash.digest())
+    return digests
+
+
+def multipart_etag(digests):
+    """Build the ETag of a multipart upload from its part digests."""
+    combined = md5(b''.join(digests))
+    return '"{}-{}"'.format(combined.hexdigest(), len(digests))
+
+
+def data_etag(data, chunk_size, threshold=None):
+    """Get the ETag S3 reports for data once uploaded by boto3."""
+    size = len(data)
+    if size < (threshold or chunk_size):
+        return '"{}"'.format(md5(data).hexdigest())
+
+    chunk_size = ChunksizeAdjuster().adjust_chunksize(chunk_size, size)
+    view = memoryview(data)
+    return multipart_etag([md5(view[i:i + chunk_size]).digest()
+                           for i in range(0, size, chunk_size)])
+
+
+def file_etag(path, chunk_size, threshold=None, pool=None, processes=1):
+    """Get the ETag S3 reports for path once uploaded by boto3.
+
+    Files smaller than threshold (chunk_size by default) are uploaded
+    in one request and get a plain md5. Larger ones are uploaded in
+    parts, with chunk_size adjusted the way s3transfer does it, and get
+    the md5 of the part digests followed by the number of parts.
+
+    With a process pool, files of at least two parts per process are
+    split into ranges of parts that are hashed on several cores.
+    """
+    size = os.stat(path).st_size
+    if size < (threshold or chunk_size):
+        return '"{}"'.format(file_md5(path).hexdigest())
+
+    chunk_size = ChunksizeAdjuster().adjust_chunksize(chunk_size, size)
+    parts = -(-size // chunk_size)
+    if pool is None or processes < 2 or parts < 2 * processes:
+        digests = part_digests(path, chunk_size)
+    else:
+        per_process = -(-parts // processes)
+        futures = [pool.submit(part_digests, path, chunk_size, first,
+                               per_process)
+                   for first in range(0, parts, per_process)]
+        digests = [digest for future in futures
+                   for digest in future.result()]
+
+    return multipart_etag(digests)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""Compact bucket manifest loaded in the background."""
+
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+
+
+def pack_etag(etag):
+    """Pack an ETag string into bytes.
+
+    '"<md5>"' becomes the 16 byte digest and '"<md5>-<parts>"' the
+    digest followed by the part count as two bytes. ETags that are not
+    hex digests are kept as their ASCII bytes.
+    """
+    if etag is None:
+        return None
+
+    digest, _, parts = etag.strip('"').partition('-')
+    try:
+        packed = bytes.fromhex(digest)
+        if parts:
+            packed += int(parts).to_bytes(2, 'big')
+    except ValueError:
+        return etag.encode('ascii')
+
+    return packed
+
+
+class Partition:
+    """A key prefix listed by one paginator."""
+
+    def __init__(self, prefix):
+        """Create a Partition for prefix."""
+        self.prefix = prefix
+        self.last = None
+        self.done = False
+
+    def covers(self, key):
+        """Return True if the listing got at least as far as key."""
+        return self.done or (self.last is not None and self.last >= key)
+
+
+class Manifest:
+    """Keys and packed ETags of a bucket, listed in the background.
+
+    list_objects_v2 returns keys in order, so a key can be looked up as
+    soon as the listing of its partition has passed it, long before the
+    whole bucket is listed. With more than one worker, top level
+    prefixes are listed in parallel, each as its own partition.
+    """
+
+    def __init__(self, client, bucket_name):
+        """Create a Manifest for bucket_name."""
+        self.client = client
+        self.bucket_name = bucket_name
+        self.etags = {}
+        self.cond = threading.Condition()
+        self.partitions = {}
+        self.root = Partition('')
+        self.split = False
+        self.pool = None
+        self.pending = 0
+        self.error = None
+
+    def start(self, workers=1):
+        """Start listing the bucket in the background."""
+        self.split = workers > 1
+        if self.split:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+
+        self.pending = 1
+        threading.Thread(target=self._list, args=(self.root,),
+                         daemon=True).start()
+        return self
+
+    def _list(self, part):
+        """List all keys of part, starting partitions for sub prefixes."""
+        try:
+            kwargs = {'Bucket': self.bucket_name, 'Prefix': part.prefix}
+            if self.split and part is self.root:
+                kwargs['Delimiter'] = '/'
+
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(**kwargs):
+                etags = [(sys.intern(obj['Key']), pack_etag(obj['ETag']))
+                         for obj in page.get('Contents', [])]
+                prefixes = [p['Prefix']
+                            for p in page.get('CommonPrefixes', [])]
+
+                with self.cond:
+                    self.etags.update(etags)
+                    for prefix in prefixes:
+                        child = self.partitions[prefix] = Partition(prefix)
+                        self.pending += 1
+                        self.pool.submit(self._list, child)
+
+                    last = [etags[-1][0]] if etags else []
+                    last += prefixes[-1:]
+                    if last:
+                        part.last = max(last)
+                    self.cond.notify_all()
+        except Exception as e:
+            with self.cond:
+                self.error = self.error or e
+        finally:
+            with self.cond:
+                part.done = True
+                self.pending -= 1
+                if not self.pending and self.pool:
+                    self.pool.shutdown(wait=False)
+                self.cond.notify_all()
+
+    def _covered(self, key):
+        """Return True if key is known to be listed or absent."""
+        if not self.split or '/' not in key:
+            return self.root.covers(key)
+
+        prefix = key[:key.index('/') + 1]
+        if not self.root.covers(prefix):
+            return False
+
+        part = self.partitions.get(prefix)
+        return part is None or part.covers(key)
+
+    def get(self, key):
+        """Get the packed ETag of key, waiting for the listing if needed."""
+        with self.cond:
+            while True:
+                if self.error:
+                    raise self.error
+                if self._covered(key):
+                    return self.etags.get(key)
+                self.cond.wait()
+
+    def matches(self, key, etag):
+        """Return True if the bucket has key with ETag etag."""
+        packed = self.get(key)
+        return packed is not None and packed == pack_etag(etag)
+
+    def wait(self):
+        """Wait until the whole bucket is listed."""
+        with self.cond:
+            while self.pending and not self.error:
+                self.cond.wait()
+            if self.error:
+                raise self.error
+        return self
+
+    def keys(self):
+        """Get all keys in the bucket."""
+        return self.wait().etags.keys()
+
+    def __len__(self):
+        """Get the number of keys listed so far."""
+        return len(self.etags)
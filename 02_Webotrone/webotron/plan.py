@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""Sync plans: what a sync will change in a bucket."""
+
+from collections import namedtuple
+import json
+import threading
+
+UPLOAD = 'upload'
+UPDATE = 'update'
+SKIP = 'skip'
+DELETE = 'delete'
+
+Change = namedtuple('Change', [
+    'action', 'key', 'size', 'reason', 'etag',
+    'content_type', 'content_encoding', 'cache_control'
+], defaults=(None,) * 6)
+
+
+class ChangeSet:
+    """All changes a sync of a local directory to a bucket makes.
+
+    A ChangeSet can be saved as JSON and applied later, to the same or
+    another bucket, without listing or hashing anything again.
+    """
+
+    VERSION = 1
+
+    def __init__(self, root, bucket_name, changes=None):
+        """Create a ChangeSet syncing directory root to bucket_name."""
+        self.root = str(root)
+        self.bucket_name = bucket_name
+        self.changes = list(changes or [])
+        self.lock = threading.Lock()
+
+    def add(self, change):
+        """Add a change, safe to call from several workers."""
+        with self.lock:
+            self.changes.append(change)
+
+    def by_action(self, action):
+        """Get the changes with action, sorted by key."""
+        return sorted((c for c in self.changes if c.action == action),
+                      key=lambda c: c.key)
+
+    @property
+    def uploads(self):
+        """Changes that upload a file."""
+        return self.by_action(UPLOAD)
+
+    @property
+    def updates(self):
+        """Unchanged files whose headers are updated in place."""
+        return self.by_action(UPDATE)
+
+    @property
+    def skips(self):
+        """Files that are already up to date."""
+        return self.by_action(SKIP)
+
+    @property
+    def deletes(self):
+        """Changes that delete a key."""
+        return self.by_action(DELETE)
+
+    def report(self):
+        """Get the uploads and deletes as printable lines."""
+        lines = ["{} {} ({} bytes, {})".format(
+                    c.action, c.key, c.size, c.reason)
+                 for c in self.uploads]
+        lines += ["{} {} ({})".format(c.action, c.key, c.reason)
+                  for c in self.updates + self.deletes]
+        lines.append("{} to upload ({} bytes), {} to update, "
+                     "{} up to date, {} to delete".format(
+                         len(self.uploads),
+                         sum(c.size for c in self.uploads),
+                         len(self.updates), len(self.skips),
+                         len(self.deletes)))
+        return lines
+
+    def to_dict(self):
+        """Get the ChangeSet as a JSON serializable dict."""
+        return {
+            'version': self.VERSION,
+            'root': self.root,
+            'bucket': self.bucket_name,
+            'changes': [c._asdict() for c in
+                        sorted(self.changes, key=lambda c: c.key)],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a ChangeSet from the output of to_dict."""
+        if data.get('version') != cls.VERSION:
+            raise ValueError("Unsupported plan version {}".format(
+                data.get('version')))
+
+        return cls(data['root'], data['bucket'],
+                   [Change(**c) for c in data['changes']])
+
+    def save(self, path):
+        """Write the ChangeSet to path as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        """Read a ChangeSet written by save."""
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
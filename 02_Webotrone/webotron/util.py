@@ -3,35 +3,137 @@
 """Utilities for webotron."""
 
 from collections import namedtuple
+import functools
+import random
+import threading
+import time
 
 Endpoint = namedtuple('Endpoint', ['name', 'host', 'zone'])
 
-region_to_endpoint = {
-    'us-east-2': Endpoint('US East (Ohio)', 's3-website.us-east-2.amazonaws.com', 'Z2O1EMRO9K5GLX'),
-    'us-east-1': Endpoint('US East (N. Virginia)', 's3-website-us-east-1.amazonaws.com', 'Z3AQBSTGFYJSTF'),
-    'us-west-1': Endpoint('US West (N. California)', 's3-website-us-west-1.amazonaws.com', 'Z2F56UZL2M1ACD'),
-    'us-west-2': Endpoint('US West (Oregon)', 's3-website-us-west-2.amazonaws.com', 'Z3BJ6K6RIION7M'),
-    'ca-central-1': Endpoint('Canada (Central)', 's3-website.ca-central-1.amazonaws.com', 'Z1QDHH18159H29'),
-    'ap-south-1': Endpoint('Asia Pacific (Mumbai)', 's3-website.ap-south-1.amazonaws.com', 'Z11RGJOFQNVJUP'),
-    'ap-northeast-2': Endpoint('Asia Pacific (Seoul)', 's3-website.ap-northeast-2.amazonaws.com', 'Z3W03O7B5YMIYP'),
-    'ap-northeast-3': Endpoint('Asia Pacific (Osaka-Local)', 's3-website.ap-northeast-3.amazonaws.com', 'Z2YQB5RD63NC85'),
-    'ap-southeast-1': Endpoint('Asia Pacific (Singapore)', 's3-website-ap-southeast-1.amazonaws.com', 'Z3O0J2DXBE1FTB'),
-    'ap-southeast-2': Endpoint('Asia Pacific (Sydney)', 's3-website-ap-southeast-2.amazonaws.com', 'Z1WCIGYICN2BYD'),
-    'ap-northeast-1': Endpoint('Asia Pacific (Tokyo)', 's3-website-ap-northeast-1.amazonaws.com', 'Z2M4EHUR26P7ZW'),
-    'cn-northwest-1': Endpoint('China (Ningxia)', 's3-website.cn-northwest-1.amazonaws.com.cn', None),
-    'eu-central-1': Endpoint('EU (Frankfurt)', 's3-website.eu-central-1.amazonaws.com', 'Z21DNDUVLTQW6Q'),
-    'eu-west-1': Endpoint('EU (Ireland)', 's3-website-eu-west-1.amazonaws.com', 'Z1BKCTXD74EZPE'),
-    'eu-west-2': Endpoint('EU (London)', 's3-website.eu-west-2.amazonaws.com', 'Z3GKZC51ZF0DB4'),
-    'eu-west-3': Endpoint('EU (Paris)', 's3-website.eu-west-3.amazonaws.com', 'Z3R1K369G5AVDG'),
-    'sa-east-1': Endpoint('South America (São Paulo)', 's3-website-sa-east-1.amazonaws.com', 'Z7KQH4QJS55SO'),
+# Regions whose website endpoint uses a dash instead of a dot before
+# the region name. Every region added since uses the dot form.
+DASH_WEBSITE_REGIONS = {
+    'us-east-1', 'us-west-1', 'us-west-2', 'ap-southeast-1',
+    'ap-southeast-2', 'ap-northeast-1', 'eu-west-1', 'sa-east-1',
+    'us-gov-west-1',
 }
 
+# Route53 hosted zone ids of the S3 website endpoints. These are not
+# part of botocore's endpoint data.
+WEBSITE_ZONE_IDS = {
+    'us-east-2': 'Z2O1EMRO9K5GLX',
+    'us-east-1': 'Z3AQBSTGFYJSTF',
+    'us-west-1': 'Z2F56UZL2M1ACD',
+    'us-west-2': 'Z3BJ6K6RIION7M',
+    'ca-central-1': 'Z1QDHH18159H29',
+    'ap-south-1': 'Z11RGJOFQNVJUP',
+    'ap-northeast-2': 'Z3W03O7B5YMIYP',
+    'ap-northeast-3': 'Z2YQB5RD63NC85',
+    'ap-southeast-1': 'Z3O0J2DXBE1FTB',
+    'ap-southeast-2': 'Z1WCIGYICN2BYD',
+    'ap-northeast-1': 'Z2M4EHUR26P7ZW',
+    'eu-central-1': 'Z21DNDUVLTQW6Q',
+    'eu-west-1': 'Z1BKCTXD74EZPE',
+    'eu-west-2': 'Z3GKZC51ZF0DB4',
+    'eu-west-3': 'Z3R1K369G5AVDG',
+    'sa-east-1': 'Z7KQH4QJS55SO',
+}
+
+
+@functools.lru_cache(maxsize=None)
+def region_to_endpoint():
+    """Get the S3 website endpoint of every region botocore knows.
+
+    Built once from botocore's endpoint data, so new regions only need
+    a newer botocore.
+    """
+    from botocore.loaders import create_loader
+
+    endpoints = {}
+    for partition in create_loader().load_data('endpoints')['partitions']:
+        for region, info in partition['regions'].items():
+            sep = '-' if region in DASH_WEBSITE_REGIONS else '.'
+            endpoints[region] = Endpoint(
+                info.get('description', region),
+                's3-website{}{}.{}'.format(sep, region,
+                                           partition['dnsSuffix']),
+                WEBSITE_ZONE_IDS.get(region))
+    return endpoints
+
 
 def known_region(region):
     """Return true if this is a known region."""
-    return region in region_to_endpoint
+    return region in region_to_endpoint()
 
 
 def get_endpoint(region):
     """Get the s3 website hosting endpoint for this region."""
-    return region_to_endpoint[region]
\ No newline at end of file
+    return region_to_endpoint()[region]
+
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def parse_size(size):
+    """Parse a size such as '512', '64M' or '4G' into bytes."""
+    size = size.strip().upper().rstrip('B').rstrip('I')
+    unit = size[-1:] if size[-1:] in SIZE_UNITS else ''
+    return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+
+
+THROTTLING_ERRORS = {
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'PriorRequestNotComplete',
+}
+
+
+def call_with_backoff(call, *args, max_attempts=8, base_delay=0.5, **kwargs):
+    """Call call(*args, **kwargs), backing off while AWS throttles it.
+
+    Waits with exponential backoff and full jitter between attempts and
+    gives up after max_attempts, re-raising the last error.
+    """
+    from botocore.exceptions import ClientError
+
+    for attempt in range(max_attempts):
+        try:
+            return call(*args, **kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in THROTTLING_ERRORS or attempt == max_attempts - 1:
+                raise
+            time.sleep(random.uniform(0, base_delay * 2 ** attempt))
+
+
+class RateLimiter:
+    """Token bucket that spreads API calls over time.
+
+    One RateLimiter is shared by all callers of an API, so together
+    they stay within rate calls per second, with bursts of up to burst
+    calls.
+    """
+
+    def __init__(self, rate, burst=1):
+        """Create a RateLimiter for rate calls per second."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a call may be made."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
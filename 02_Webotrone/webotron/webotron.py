@@ -13,65 +13,64 @@ Webotrone automates the process of deploying static websites to AWS
 
 """
 
-import boto3
 import click
-from bucket import BucketManager
-from domain import DomainManager
-from certificate import CertificateManager
-from cdn import DistributionManager
+import cache
+from context import WebotronContext
+from plan import ChangeSet
 import util
 
 
-session = None
-bucket_manager = None
-domain_manager = None
-certificate = None
-
-
 @click.group()
 @click.option('--profile', default=None,
     help="Use a given AWS profile.")
-def cli(profile):
+@click.option('--cache-ttl', default=cache.DEFAULT_TTL,
+    show_default=True, type=click.IntRange(min=0),
+    help="Seconds to keep AWS lookups cached on disk, 0 to disable.")
+@click.pass_context
+def cli(ctx, profile, cache_ttl):
     """Webotron deploys websites to AWS"""
 
-    global session, bucket_manager, domain_manager, cert_manager, dist_manager
+    ctx.obj = WebotronContext(profile, cache_ttl)
+
 
-    session_cfg = {}
-    if profile:
-        session_cfg['profile_name'] = profile
+def read_domains(domains_file):
+    """Read domains, one per line, skipping blanks and # comments.
+
+    Domains listed more than once are only returned the first time.
+    """
+    return list(dict.fromkeys(
+        line.strip() for line in domains_file
+        if line.strip() and not line.strip().startswith('#')))
 
-    session = boto3.Session(**session_cfg)
-    domain_manager = DomainManager(session)
-    bucket_manager = BucketManager(session)
-    cert_manager = CertificateManager(session)
-    dist_manager = DistributionManager(session)
-    
 
 @cli.command('list-buckets')
-def list_buckets():
+@click.pass_obj
+def list_buckets(obj):
     """List all s3 buckets"""
-    for bucket in bucket_manager.all_buckets():
+    for bucket in obj.bucket_manager.all_buckets():
         print(bucket)
     return
 
 
 @cli.command('list-bucket-objects')
 @click.argument('bucket')
-def list_bucket_objects(bucket):
+@click.pass_obj
+def list_bucket_objects(obj, bucket):
     """List objects in an s3 bucket"""
-    for obj in bucket_manager.all_objects(bucket):
-        print(obj)
+    for s3_object in obj.bucket_manager.all_objects(bucket):
+        print(s3_object)
     return
 
 
 @cli.command('setup-bucket')
 @click.argument('bucket')
-def setup_bucket(bucket):
+@click.pass_obj
+def setup_bucket(obj, bucket):
     """Create and configure S3 bucket"""
 
-    s3_bucket = bucket_manager.init_bucket(bucket)
-    bucket_manager.set_policy(s3_bucket)
-    bucket_manager.configure_website(s3_bucket)
+    s3_bucket = obj.bucket_manager.init_bucket(bucket)
+    obj.bucket_manager.set_policy(s3_bucket)
+    obj.bucket_manager.configure_website(s3_bucket)
 
     return
 
@@ -79,58 +78,351 @@ def setup_bucket(bucket):
 @cli.command('sync')
 @click.argument('pathname', type=click.Path(exists=True))
 @click.argument('bucket')
-def sync(pathname, bucket):
+@click.option('--workers', default=1, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of files to hash and upload in parallel.")
+@click.option('--etag-cache/--no-etag-cache', default=True,
+    show_default=True,
+    help="Keep the ETags of local files in the webotron cache directory.")
+@click.option('--listing-workers', default=1, show_default=True,
+    type=click.IntRange(min=1),
+    help="List top level prefixes of BUCKET in parallel.")
+@click.option('--delete', is_flag=True,
+    help="Delete keys in BUCKET that have no file in PATHNAME.")
+@click.option('--max-delete', default=None, type=click.IntRange(min=0),
+    help="Refuse to delete more than this many keys.")
+@click.option('--dry-run', is_flag=True,
+    help="Only show what would be uploaded and deleted.")
+@click.option('--save-plan', default=None, type=click.Path(dir_okay=False),
+    help="Save what the sync changes to this file.")
+@click.option('--apply-plan', default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Apply a plan saved with --save-plan instead of comparing "
+         "PATHNAME with BUCKET again.")
+@click.option('--hash-processes', default=1, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of processes hashing parts of large files.")
+@click.option('--compress', default=None, type=click.Choice(['gzip', 'br']),
+    help="Upload text assets compressed with this Content-Encoding.")
+@click.option('--cache-control', multiple=True, metavar='EXT=VALUE',
+    help="Cache-Control for files with extension EXT, e.g. "
+         "'.html=max-age=300'. May be repeated.")
+@click.option('--transfer-class', 'transfer_classes', multiple=True,
+    metavar='MIN:PART:THREADS',
+    help="Upload files of at least MIN bytes in PART sized parts with "
+         "THREADS threads, e.g. '1G:64M:16'. Replaces the built-in "
+         "classes, one of which must start at 0. May be repeated.")
+@click.option('--invalidate', is_flag=True,
+    help="Invalidate changed files in the CloudFront distribution "
+         "whose alias is BUCKET.")
+@click.option('--wait-invalidation', is_flag=True,
+    help="With --invalidate, wait until the invalidation completes.")
+@click.pass_obj
+def sync(obj, pathname, bucket, workers, etag_cache, listing_workers, delete,
+         max_delete, dry_run, save_plan, apply_plan, hash_processes,
+         compress, cache_control, transfer_classes, invalidate,
+         wait_invalidation):
     "Sync content of PATHNAME to BUCKET"
 
-    bucket_manager.sync(pathname, bucket)
-    print(bucket_manager.get_bucket_url(bucket_manager.s3.Bucket(bucket)))
+    rules = {}
+    for rule in cache_control:
+        ext, sep, value = rule.partition('=')
+        if not sep or not ext:
+            raise click.BadParameter(
+                "expected EXT=VALUE, got {}".format(rule),
+                param_hint='--cache-control')
+        rules['.' + ext.lstrip('.').lower()] = value
+
+    classes = []
+    for transfer_class in transfer_classes:
+        try:
+            min_size, part_size, threads = transfer_class.split(':')
+            classes.append((util.parse_size(min_size),
+                            util.parse_size(part_size), int(threads)))
+        except ValueError:
+            raise click.BadParameter(
+                "expected MIN:PART:THREADS, got {}".format(transfer_class),
+                param_hint='--transfer-class')
+
+    try:
+        if classes:
+            obj.bucket_manager.set_transfer_classes(classes)
+
+        if apply_plan:
+            changeset = ChangeSet.load(apply_plan)
+            stats = None
+            if not dry_run:
+                stats = obj.bucket_manager.apply(changeset, pathname, bucket,
+                                             workers)
+        else:
+            changeset, stats = obj.bucket_manager.sync(
+                pathname, bucket, workers, etag_cache, listing_workers,
+                delete, dry_run, max_delete, hash_processes, compress,
+                rules)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    if save_plan:
+        changeset.save(save_plan)
+
+    if dry_run:
+        for line in changeset.report():
+            print(line)
+    else:
+        print(stats.summary())
+
+    if invalidate and stats and stats.changed_keys:
+        dist = obj.dist_manager.find_matching_dist(bucket)
+        if not dist:
+            print("No distribution found for {}, "
+                  "nothing invalidated.".format(bucket))
+        else:
+            if wait_invalidation:
+                print("Waiting for invalidation...")
+            invalidation = obj.dist_manager.invalidate(
+                dist, stats.changed_keys, wait_invalidation)
+            print("Invalidation {} of {} paths for {}".format(
+                invalidation['Id'],
+                invalidation['InvalidationBatch']['Paths']['Quantity'],
+                dist['Id']))
+
+    print(obj.bucket_manager.get_bucket_url(
+        obj.bucket_manager.get_bucket(bucket)))
     pass
 
 @cli.command('setup-domain')
 @click.argument('domain')
-def setup_domain(domain):
+@click.pass_obj
+def setup_domain(obj, domain):
     """Configure DOMAIN to point to BUCKET."""
 
-    bucket = bucket_manager.get_bucket(domain)
-    zone = domain_manager.find_hosted_zone(domain)
-        # or domain_manager.create_hosted_zone(domain)
+    bucket = obj.bucket_manager.get_bucket(domain)
+    zone = obj.domain_manager.find_hosted_zone(domain)
+        # or obj.domain_manager.create_hosted_zone(domain)
 
-    endpoint = util.get_endpoint(bucket_manager.get_region_name(bucket))
-    domain_manager.create_s3_domain_record(zone, domain, endpoint)
+    endpoint = util.get_endpoint(obj.bucket_manager.get_region_name(bucket))
+    obj.domain_manager.create_s3_domain_record(zone, domain, endpoint)
     print("Domain configure: http://{}".format(domain))
 
 
+@cli.command('setup-domains')
+@click.argument('domains_file', type=click.File())
+@click.option('--wait/--no-wait', default=True, show_default=True,
+    help="Wait until Route53 has applied the records.")
+@click.pass_obj
+def setup_domains(obj, domains_file, wait):
+    """Point every domain in DOMAINS_FILE to its bucket.
+
+    DOMAINS_FILE has one domain per line; blank lines and lines
+    starting with # are ignored. Records are sent in as few batches per
+    hosted zone as Route53 allows.
+    """
+    from botocore.exceptions import ClientError
+
+    domains = read_domains(domains_file)
+
+    changes = {}
+    for domain in domains:
+        zone = obj.domain_manager.find_hosted_zone(domain)
+        if not zone:
+            print("Skipping {}, no hosted zone found.".format(domain))
+            continue
+
+        bucket = obj.bucket_manager.get_bucket(domain)
+        try:
+            region = obj.bucket_manager.get_region_name(bucket)
+        except ClientError as e:
+            print("Skipping {}, no usable bucket: {}".format(
+                domain, e.response['Error']['Code']))
+            continue
+        endpoint = util.get_endpoint(region)
+        changes.setdefault(zone['Id'], (zone, []))[1].append(
+            obj.domain_manager.s3_alias_change(domain, endpoint))
+
+    change_infos = obj.domain_manager.change_records_batched(changes.values())
+    print("Sent {} batches for {} domains in {} zones.".format(
+        len(change_infos), sum(len(c) for _, c in changes.values()),
+        len(changes)))
+
+    if wait:
+        print("Waiting for changes...")
+        obj.domain_manager.await_changes(change_infos)
+        print("Domains configured.")
+
+
 @cli.command('find-cert')
-@click.argument('domain')
-def find_cert(domain):
-    """Find a certificate for <DOMAIN>."""
-    print(cert_manager.find_matching_cert(domain))
+@click.argument('domains', nargs=-1, required=True)
+@click.pass_obj
+def find_cert(obj, domains):
+    """Find a certificate for each of DOMAINS."""
+    found = obj.cert_manager.find_matching_certs(domains)
+    if len(domains) == 1:
+        print(found[domains[0]])
+        return
+
+    for domain in domains:
+        print("{}: {}".format(domain, found[domain]))
 
 
 @cli.command('setup-cdn')
 @click.argument('domain')
 @click.argument('bucket')
-def setup_cdn(domain, bucket):
+@click.pass_obj
+def setup_cdn(obj, domain, bucket):
     """Set up CloudFront CDN for DOMAIN pointing to BUCKET."""
-    dist = dist_manager.find_matching_dist(domain)
+    dist = obj.dist_manager.find_matching_dist(domain)
 
     if not dist:
-        cert = cert_manager.find_matching_cert(domain)
+        cert = obj.cert_manager.find_matching_cert(domain)
         if not cert:  # SSL is not optional at this time
             print("Error: No matching cert found.")
             return
 
-        dist = dist_manager.create_dist(domain, cert)
+        dist = obj.dist_manager.create_dist(domain, cert)
         print("Waiting for distribution deployment...")
-        dist_manager.await_deploy(dist)
+        obj.dist_manager.await_deploy(dist)
 
-    zone = domain_manager.find_hosted_zone(domain) \
-        or domain_manager.create_hosted_zone(domain)
+    zone = obj.domain_manager.find_hosted_zone(domain) \
+        or obj.domain_manager.create_hosted_zone(domain)
 
-    domain_manager.create_cf_domain_record(zone, domain, dist['DomainName'])
+    obj.domain_manager.create_cf_domain_record(
+        zone, domain, dist['DomainName'])
     print("Domain configured: https://{}".format(domain))
 
     return
 
+
+@cli.command('setup-cdns')
+@click.argument('domains_file', type=click.File())
+@click.option('--poll-rate', default=2.0, show_default=True,
+    help="Most distribution status polls per second, for all domains.")
+@click.pass_obj
+def setup_cdns(obj, domains_file, poll_rate):
+    """Set up CloudFront CDNs for every domain in DOMAINS_FILE.
+
+    Distributions are created for all domains first and their
+    deployments are tracked together. Each domain gets its Route53
+    record as soon as its own distribution is deployed.
+    """
+    domains = read_domains(domains_file)
+    dists = obj.dist_manager.find_matching_dists(domains)
+    certs = obj.cert_manager.find_matching_certs(
+        [domain for domain in domains if not dists[domain]])
+    tracker = obj.dist_manager.track_deploys(rate=poll_rate)
+
+    def configure(domain):
+        def on_deployed(dist):
+            zone = obj.domain_manager.find_hosted_zone(domain) \
+                or obj.domain_manager.create_hosted_zone(domain)
+            obj.domain_manager.create_cf_domain_record(
+                zone, domain, dist['DomainName'])
+            print("Domain configured: https://{}".format(domain))
+        return on_deployed
+
+    for domain in domains:
+        dist = dists[domain]
+        if dist:
+            configure(domain)(dist)
+            continue
+
+        if not certs[domain]:
+            print("Error: No matching cert found for {}.".format(domain))
+            continue
+
+        tracker.add(obj.dist_manager.create_dist(domain, certs[domain]),
+                    configure(domain))
+
+    if tracker.queue:
+        print("Waiting for {} distribution deployments...".format(
+            len(tracker.queue)))
+        for dist_id, status in tracker.run().items():
+            if status != 'Deployed':
+                print("Distribution {} is still {}.".format(dist_id, status))
+
+
+@cli.command('deploy')
+@click.argument('sites_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=1, show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of files each sync hashes and uploads in parallel.")
+@click.option('--limit', 'limits', multiple=True, metavar='SERVICE=N',
+    help="Run at most N steps of SERVICE (s3, sync, acm, cloudfront, "
+         "route53) at the same time. May be repeated.")
+@click.option('--wait', is_flag=True,
+    help="Wait for new distributions and DNS records to be deployed.")
+@click.option('--dry-run', is_flag=True,
+    help="Only show the steps and what each one waits for.")
+@click.pass_obj
+def deploy(obj, sites_file, workers, limits, wait, dry_run):
+    """Deploy every site defined in SITES_FILE.
+
+    SITES_FILE is YAML (with PyYAML installed) or JSON, holding a list
+    of sites under 'sites'. Each site has a domain and optionally a
+    bucket (the domain by default, and only different with cdn: true
+    or dns: false), a path to sync, cdn: true to serve it through
+    CloudFront, dns: false to leave Route53 alone, and the delete,
+    compress and cache_control settings of sync.
+    """
+    from deploy import DONE, SKIPPED, Deployer, load_sites
+
+    service_limits = {}
+    for limit in limits:
+        service, sep, count = limit.partition('=')
+        if not sep or not count.isdigit() or int(count) < 1:
+            raise click.BadParameter(
+                "expected SERVICE=N, got {}".format(limit),
+                param_hint='--limit')
+        service_limits[service] = int(count)
+
+    try:
+        sites = load_sites(sites_file)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    graph = Deployer(obj, service_limits, workers).plan(sites)
+    if dry_run:
+        for task in graph.tasks.values():
+            print("{} [{}]{}".format(
+                task.name, task.service,
+                " after " + ', '.join(task.needs) if task.needs else ''))
+        return
+
+    def on_done(task):
+        if task.status == SKIPPED:
+            print("{} {}: {} did not complete".format(
+                task.status, task.name, ', '.join(task.needs)))
+        elif task.status != DONE:
+            print("{} {}: {}".format(task.status, task.name, task.error))
+        elif task.name.startswith('sync:'):
+            print("{} {}: {}".format(task.status, task.name,
+                                     task.result.summary()))
+        else:
+            print("{} {}".format(task.status, task.name))
+
+    tasks = graph.run(on_done)
+    done = [task for task in tasks.values() if task.status == DONE]
+    print("{} of {} steps done for {} sites.".format(
+        len(done), len(tasks), len(sites)))
+
+    if wait:
+        change_infos = [task.result for task in done
+                        if task.name.startswith('dns:')]
+        tracker = obj.dist_manager.track_deploys()
+        for task in done:
+            if task.name.startswith('distribution:') and \
+                    task.result.get('Status') != 'Deployed':
+                tracker.add(task.result)
+
+        print("Waiting for {} distributions and {} DNS changes...".format(
+            len(tracker.queue), len(change_infos)))
+        obj.domain_manager.await_changes(change_infos)
+        for dist_id, status in tracker.run().items():
+            if status != 'Deployed':
+                print("Distribution {} is still {}.".format(dist_id, status))
+
+    if len(done) < len(tasks):
+        raise click.ClickException("Some steps failed or were skipped.")
+
+
 if __name__ == '__main__':
     cli()